@@ -0,0 +1,261 @@
+# Benchmarks for the render pipeline. They build one batch of a json file and render
+# a few of its views with different output settings, run them inside blender:
+# blender -b --python benchmark.py -- {codecs,layouts,capture,presets} render.json [--batch 0] [--frames 8]
+
+import os
+import sys
+import copy
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import itertools
+import numpy as np
+import bpy
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import render  # noqa: E402
+
+
+EXR_CODECS = ["NONE", "ZIP", "PIZ", "DWAA"]
+EXR_PRECISIONS = ["half", "float"]
+PNG_COMPRESSIONS = [0, 15, 50, 90]
+PNG_COLOR_DEPTHS = ["8", "16"]
+
+
+def setup_batch(data, batch_index):
+    # import the objects and create the scene of a batch like render.py does
+    batches = data.get("batches", [])
+    render.CLASSES = data.get("classes", [])
+    render.NUM_BATCHES = len(batches)
+    render.RESUME = {}
+    render.initialize_blender()
+
+    batch = batches[batch_index]
+    objects = render.setup_imports(batch.get("imports", []), batch_index=batch_index)
+    render.setup_scene(batch.get("scene", {}), batch_index=batch_index)
+    render.setup_lod(objects, batch.get("render", {}))
+    bpy.ops.scene.light_cache_bake(delay=0, subset='ALL')
+    return objects, batch.get("render", {})
+
+
+def get_views(data, count):
+    views_x, views_y, views_z = render.load_render_views(data["views"])
+    return list(itertools.islice(itertools.product(views_x, views_y, views_z), count))
+
+
+def render_frames(views):
+    # render the views, returns the seconds spent on each frame
+    times = []
+    for frame, rotation in enumerate(views):
+        bpy.context.scene.frame_set(frame)
+        bpy.context.scene.camera.parent.rotation_euler = rotation
+        ti = time.time()
+        old = render.blockPrint()
+        bpy.ops.render.render()
+        render.enablePrint(old)
+        times.append(time.time() - ti)
+    return times
+
+
+def mute_file_outputs(mute=True):
+    for node in bpy.context.scene.node_tree.nodes:
+        if node.bl_idname == "CompositorNodeOutputFile":
+            node.mute = mute
+
+
+def output_sizes(path):
+    # bytes written per pass label, files are named <id>_<frame><label>.<ext>
+    sizes = {}
+    for name in os.listdir(path):
+        label = os.path.splitext(name)[0][render.FNAME_FORMAT + 1 + render.FRAME_FORMAT:]
+        sizes[label] = sizes.get(label, 0) + os.path.getsize(os.path.join(path, name))
+    return sizes
+
+
+def read_outputs(path):
+    # seconds to open and read back every file written
+    ti = time.time()
+    for name in os.listdir(path):
+        with open(os.path.join(path, name), 'rb') as f:
+            f.read()
+    return time.time() - ti
+
+
+def run_setting(data, batch_index, views, name, mute=False):
+    # render the views with the given render config into a scratch directory
+    output_path = tempfile.mkdtemp(prefix="benchmark_")
+    try:
+        render.setup_render_tree(data, output_path, batch_index)
+        mute_file_outputs(mute)
+        times = render_frames(views)
+        sizes = output_sizes(output_path)
+        files = len(os.listdir(output_path))
+        read = read_outputs(output_path)
+    finally:
+        shutil.rmtree(output_path, ignore_errors=True)
+    return {"name": name, "seconds": sum(times) / len(times), "sizes": sizes,
+            "files": files / len(views), "read": read / len(views)}
+
+
+def print_results(results, baseline, frames):
+    print("{0:32} {1:>9} {2:>9} {3:>9} {4:>9} {5:>9}  {6}".format(
+        "setting", "s/frame", "write s", "read s", "files", "MB/frame", "MB/frame per pass"))
+    for result in results:
+        per_pass = ", ".join("%s %.3f" % (label, size / frames / 2 ** 20)
+                             for label, size in sorted(result["sizes"].items()))
+        print("{0:32} {1:9.3f} {2:9.3f} {3:9.4f} {4:9.1f} {5:9.3f}  {6}".format(
+            result["name"][:32], result["seconds"], result["seconds"] - baseline["seconds"],
+            result["read"], result["files"], sum(result["sizes"].values()) / frames / 2 ** 20, per_pass))
+
+
+def benchmark_codecs(data, opt):
+    # compare write time and size of the EXR codecs/precisions and PNG compression levels
+    objects, render_data = setup_batch(data, opt.batch)
+    views = get_views(render_data, opt.frames)
+    exr_passes = ["depth", "normal", "albedo", "flow"]
+
+    # warm up shaders and the light cache, then render without writing anything
+    run_setting(render_data, opt.batch, views[:1], "warmup", mute=True)
+    baseline = run_setting(render_data, opt.batch, views, "no output", mute=True)
+
+    results = []
+    for codec, precision in itertools.product(EXR_CODECS, EXR_PRECISIONS):
+        setting = copy.deepcopy(render_data)
+        setting["formats"] = {p: {"codec": codec, "precision": precision} for p in exr_passes}
+        results.append(run_setting(setting, opt.batch, views, f"exr {codec} {precision}"))
+    for compression, color_depth in itertools.product(PNG_COMPRESSIONS, PNG_COLOR_DEPTHS):
+        setting = copy.deepcopy(render_data)
+        setting["formats"] = {"rgb": {"compression": compression, "color_depth": color_depth}}
+        results.append(run_setting(setting, opt.batch, views, f"png {compression}% {color_depth}bit"))
+
+    print_results(results, baseline, len(views))
+
+
+def benchmark_layouts(data, opt):
+    # compare a file per pass against a single multilayer EXR per frame
+    objects, render_data = setup_batch(data, opt.batch)
+    views = get_views(render_data, opt.frames)
+
+    run_setting(render_data, opt.batch, views[:1], "warmup", mute=True)
+    baseline = run_setting(render_data, opt.batch, views, "no output", mute=True)
+
+    results = []
+    for multilayer in [False, True]:
+        setting = copy.deepcopy(render_data)
+        setting["multilayer"] = multilayer
+        results.append(run_setting(setting, opt.batch, views, "multilayer" if multilayer else "file per pass"))
+
+    print_results(results, baseline, len(views))
+
+
+def run_capture(data, batch_index, views, name, workers):
+    # render the views captured to numpy, the time per frame includes waiting for the encoders
+    output_path = tempfile.mkdtemp(prefix="benchmark_")
+    pool = render.EncoderPool(workers, dtype=data.get("capture_dtype", "float16"))
+    scratch_path = pool.scratch_path
+    try:
+        render.setup_render_tree(data, scratch_path, batch_index)
+        ti = time.time()
+        for frame, rotation in enumerate(views):
+            render_frames([rotation])
+            pool.submit(frame, output_path=output_path,
+                        prefix=f'%0{render.FNAME_FORMAT}d_%0{render.FRAME_FORMAT}d' % (batch_index, frame))
+            pool.collect()
+        pool.close()
+        seconds = time.time() - ti
+        sizes = output_sizes(output_path)
+        files = len(os.listdir(output_path))
+        read = read_outputs(output_path)
+    finally:
+        shutil.rmtree(output_path, ignore_errors=True)
+        shutil.rmtree(scratch_path, ignore_errors=True)
+    return {"name": name, "seconds": seconds / len(views), "sizes": sizes,
+            "files": files / len(views), "read": read / len(views)}
+
+
+def benchmark_capture(data, opt):
+    # compare the file outputs against capturing to numpy with background encoders
+    objects, render_data = setup_batch(data, opt.batch)
+    views = get_views(render_data, opt.frames)
+
+    run_setting(render_data, opt.batch, views[:1], "warmup", mute=True)
+    baseline = run_setting(render_data, opt.batch, views, "no output", mute=True)
+
+    results = []
+    for multilayer in [False, True]:
+        setting = copy.deepcopy(render_data)
+        setting["multilayer"] = multilayer
+        results.append(run_setting(setting, opt.batch, views, "multilayer" if multilayer else "file per pass"))
+    for workers, dtype in itertools.product([1, 2, 4], ["float16", "float32"]):
+        setting = dict(copy.deepcopy(render_data), capture="numpy", capture_dtype=dtype)
+        results.append(run_capture(setting, opt.batch, views, f"numpy {dtype} {workers} workers", workers))
+
+    print_results(results, baseline, len(views))
+
+
+def read_png(path):
+    # the pixels of a png as a (height, width, channels) float array through blender
+    image = bpy.data.images.load(path)
+    width, height = image.size
+    pixels = np.empty(width * height * image.channels, dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    bpy.data.images.remove(image)
+    return pixels.reshape(height, width, -1)[..., :3]
+
+
+def run_preset(data, batch_index, views, preset):
+    # render the rgb pass of the views with a preset, returns the time per frame and the images
+    output_path = tempfile.mkdtemp(prefix="benchmark_")
+    setting = dict(copy.deepcopy(data), preset=preset, passes=["rgb"], multilayer=False, capture="files")
+    try:
+        render.setup_render_tree(setting, output_path, batch_index)
+        times = render_frames(views)
+        images = [read_png(os.path.join(output_path, name)) for name in sorted(os.listdir(output_path))]
+    finally:
+        shutil.rmtree(output_path, ignore_errors=True)
+    return sum(times) / len(times), images
+
+
+def benchmark_presets(data, opt):
+    # frames per second of the eevee presets and how far their images are from production
+    objects, render_data = setup_batch(data, opt.batch)
+    if render_data.get("type", "basic") == "flow":
+        raise ValueError("the presets are eevee settings, use a basic or stereo batch")
+    views = get_views(render_data, opt.frames)
+
+    run_preset(render_data, opt.batch, views[:1], "draft")
+    results = {preset: run_preset(render_data, opt.batch, views, preset) for preset in render.EEVEE_PRESETS}
+    reference = results["production"][1]
+
+    print("{0:12} {1:>9} {2:>9} {3:>12} {4:>9}".format("preset", "s/frame", "fps", "mean abs diff", "psnr"))
+    for preset, (seconds, images) in results.items():
+        errors = [np.abs(image - target) for image, target in zip(images, reference)]
+        mse = np.mean([np.mean(error ** 2) for error in errors])
+        psnr = 10 * np.log10(1 / mse) if mse > 0 else float('inf')
+        print("{0:12} {1:9.3f} {2:9.2f} {3:12.5f} {4:9.2f}".format(
+            preset, seconds, 1 / seconds, np.mean([np.mean(error) for error in errors]), psnr))
+
+
+BENCHMARKS = {
+    "codecs": benchmark_codecs,
+    "layouts": benchmark_layouts,
+    "capture": benchmark_capture,
+    "presets": benchmark_presets,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks the render pipeline')
+    parser.add_argument('benchmark', type=str, choices=list(BENCHMARKS), help='benchmark to run')
+    parser.add_argument('json', type=str, help='Path to the json file to be used for rendering.')
+    parser.add_argument('--batch', type=int, default=0, help='batch of the json file to render')
+    parser.add_argument('--frames', type=int, default=8, help='number of views rendered per setting')
+    opt = sys.argv[sys.argv.index("--") + 1:]
+    opt = parser.parse_args(opt)
+
+    with open(opt.json, 'r') as json_file:
+        data = json.load(json_file)
+
+    BENCHMARKS[opt.benchmark](data, opt)
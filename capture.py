@@ -0,0 +1,124 @@
+# Background encoding of captured frames for render.py. A frame is captured as an
+# uncompressed multilayer EXR on a scratch directory, ideally in memory, which the encoder
+# processes map into numpy and save as one .npy array per pass, so the encoding never
+# blocks the next render. Blender holds the GIL while rendering, so the encoders are
+# separate python processes fed through pipes rather than threads.
+
+import os
+import sys
+import json
+import queue
+import tempfile
+import threading
+import subprocess
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import exr  # noqa: E402
+
+
+LAYERS_LABEL = "layers"
+
+
+def get_scratch_path():
+    # shared memory when available, the capture files never need to reach the disk
+    return tempfile.mkdtemp(prefix="capture_", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+
+
+def encode_frame(scratch_path, output_path, prefix, dtype="float16"):
+    """Save every layer of the captured files of a frame as .npy arrays and remove them
+
+    Args:
+        scratch_path (str): directory holding the captured <prefix>layers[_view].exr files
+        output_path (str): directory the arrays are written to, as <prefix><layer>[_view].npy
+        prefix (str): the <batch>_<frame> prefix of the files
+        dtype (str): dtype of the saved arrays
+    """
+    for name in sorted(os.listdir(scratch_path)):
+        if not name.startswith(prefix + LAYERS_LABEL) or not name.endswith(".exr"):
+            continue
+        path = os.path.join(scratch_path, name)
+        suffix = name[len(prefix + LAYERS_LABEL):-len(".exr")]
+        for layer, pixels in exr.read_layers(path).items():
+            np.save(os.path.join(output_path, prefix + layer + suffix + ".npy"), pixels.astype(dtype))
+        os.remove(path)
+
+
+class EncoderPool():
+    """Worker processes running encode_frame, jobs are sent round robin
+
+    Args:
+        workers (int): Number of encoder processes
+        python (str): Interpreter running the encoders, the current one by default
+        scratch_path (str): Directory the frames are captured to, a new one from
+            get_scratch_path by default
+        dtype (str): dtype of the saved arrays
+    """
+
+    def __init__(self, workers=2, python=None, scratch_path=None, dtype="float16"):
+        self.scratch_path = scratch_path or get_scratch_path()
+        self.dtype = dtype
+        self.done = queue.Queue()
+        self.pending = set()
+        self.next_worker = 0
+        self.processes = []
+        for _ in range(max(1, workers)):
+            process = subprocess.Popen(
+                [python or sys.executable, os.path.abspath(__file__)],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1)
+            reader = threading.Thread(target=self.read_results, args=(process,), daemon=True)
+            reader.start()
+            self.processes.append((process, reader))
+
+    def read_results(self, process):
+        for line in process.stdout:
+            self.done.put(json.loads(line))
+        # only reached before close if the worker died, fail the pending jobs instead of waiting
+        self.done.put({"key": None, "error": f"encoder exited with code {process.wait()}"})
+
+    def submit(self, key, **job):
+        # encode_frame arguments, the scratch path and dtype of the pool unless given
+        job = dict({"scratch_path": self.scratch_path, "dtype": self.dtype}, **job)
+        process, _ = self.processes[self.next_worker]
+        self.next_worker = (self.next_worker + 1) % len(self.processes)
+        self.pending.add(key)
+        process.stdin.write(json.dumps({"key": key, "job": job}) + "\n")
+
+    def collect(self, block=False):
+        # keys of the jobs finished since the last call
+        finished = []
+        while self.pending:
+            try:
+                result = self.done.get(block=block)
+            except queue.Empty:
+                break
+            if "error" in result:
+                raise RuntimeError(f"encoding {result['key']} failed: {result['error']}")
+            self.pending.discard(result["key"])
+            finished.append(result["key"])
+        return finished
+
+    def close(self):
+        # wait for the remaining jobs and stop the workers, returns the keys finished
+        finished = self.collect(block=True)
+        for process, reader in self.processes:
+            process.stdin.close()
+            process.wait()
+            reader.join()
+        return finished
+
+
+def worker():
+    for line in sys.stdin:
+        request = json.loads(line)
+        try:
+            encode_frame(**request["job"])
+            result = {"key": request["key"]}
+        except Exception as e:
+            result = {"key": request["key"], "error": repr(e)}
+        sys.stdout.write(json.dumps(result) + "\n")
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    worker()
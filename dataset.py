@@ -1,11 +1,38 @@
-import shutil
-import glob
+# Builds the dataset of a render output, for every render type. The record fields follow the
+# type (SCHEMAS) and the passes the output has: a field is built when its pass was rendered,
+# so flow, albedo, disparity or mesh outputs get their own fields. The frames are processed
+# on a process pool.
+# python dataset.py bdataset [--type {auto,basic,stereo}] [--source out] [--workers 8]
+
+import os
 import json
+import time
+import shutil
+import argparse
+import tempfile
 from os import getcwd
 from os.path import join
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
-import argparse
+from dataset_utils import (LINK_MODES, FrameIndex, FrameJournal, export_shards, file_mtimes, frame_key, is_test,
+                           link_file, load_manifest, parse_name, report_incomplete, save_manifest, scan_passes)
+from stats import STATS, frame_stats, reduce_stats
+
+
+# record field -> pass of the files of each render type. the fields of stereo renders are
+# per view, imageL and imageR for the stereo pass. flow renders have the fields of basic ones,
+# their flow field comes from the pass like any other
+SCHEMAS = {
+    "basic": {"image": "rgb", "normal": "normal", "depth": "depth", "albedo": "albedo", "flow": "flow"},
+    "stereo": {"image": "stereo", "normal": "normal", "depth": "depth", "disparity": "disparity",
+               "consistency": "consistency"},
+}
+VIEWS = {"basic": [None], "stereo": ["L", "R"]}
+# per frame annotations, the label and rotation values are stored in the record and the
+# other files are placed in the dataset like the passes
+ANNOTATIONS = ["label", "rotation", "mesh", "instances"]
+TYPES = ["auto"] + list(SCHEMAS)
 
 
 def read_label(path):
@@ -20,45 +47,314 @@ def read_rotation(path):
     return l
 
 
-parser = argparse.ArgumentParser(description="dataset tree structure")
-parser.add_argument("dest", type=str, default="bdataset")
-opt = parser.parse_args()
-
-DATASET = opt.dest
-wd = Path(getcwd())
-root = wd.parent
-data_path = Path(join(wd, 'out'))
-
-Path(join(root, DATASET)).mkdir(parents=True, exist_ok=True)
-
-images = sorted(glob.glob(str(data_path / '*rgb.png'), recursive=True))
-normals = sorted(glob.glob(str(data_path / '*normal.exr'), recursive=True))
-depths = sorted(glob.glob(str(data_path / '*depth.exr'), recursive=True))
-labels = sorted(glob.glob(str(data_path / '*label.txt'), recursive=True))
-rotations = sorted(glob.glob(str(data_path / '*rotation.txt'), recursive=True))
-
-STEP = 3
-
-JSON_TRAIN_DATA = []
-JSON_TEST_DATA = []
-
-index = 0
-loop = tqdm(zip(images, normals, depths, labels, rotations))
-for i, (img, normal, depth, label_path, rotation_path) in enumerate(loop):
-    shutil.copy(img, join(root, DATASET))
-    shutil.copy(normal, join(root, DATASET))
-    shutil.copy(depth, join(root, DATASET))
-    label = read_label(label_path)
-    rotation = read_rotation(rotation_path)
-    (JSON_TEST_DATA if i % STEP == 0 else JSON_TRAIN_DATA).append({
-        "image": Path(img).name,
-        "normal": Path(normal).name,
-        "depth": Path(depth).name,
-        "label": label,
-        "rotation": rotation,
-    })
-
-with open(join(root, DATASET, "train.json"), "w") as f:
-    json.dump(JSON_TRAIN_DATA, f)
-with open(join(root, DATASET, "test.json"), "w") as f:
-    json.dump(JSON_TEST_DATA, f)
+PARSERS = {"label": read_label, "rotation": read_rotation}
+
+
+def detect_type(passes):
+    # stereo renders name their files by view
+    if any(view is not None for _, view in passes):
+        return "stereo"
+    return "basic"
+
+
+def get_fields(passes, render_type):
+    """The FrameIndex fields of a render output
+
+    Args:
+        passes (dict): The passes of the output, as returned by scan_passes
+        render_type (str): basic or stereo
+
+    Returns:
+        dict: record field to the candidates of its files, for the passes the output has
+    """
+    fields = {}
+    for field, name in SCHEMAS[render_type].items():
+        for view in VIEWS[render_type]:
+            if (name, view) in passes:
+                fields[field + (view or "")] = passes[(name, view)]
+    for name in ANNOTATIONS:
+        if (name, None) in passes:
+            fields[name] = passes[(name, None)]
+    return fields
+
+
+def build_frame(job):
+    """Parse the annotations of a frame and place its files in the dataset
+
+    Args:
+        job (tuple): (key, files, previous, dest, link mode, stats maxvalue). files is the
+            FrameIndex record of the frame, previous its manifest entry, dest None when nothing
+            is placed and the maxvalue None when the statistics are not computed
+
+    Returns:
+        tuple: (key, manifest entry, number of files per link mode used). The previous
+        entry is returned as is when the mtimes of the files and the maxvalue didn't change and
+        the files are still in the dataset, placed with the same link mode
+    """
+    key, files, previous, dest, mode, maxvalue = job
+    mtimes = file_mtimes(files)
+    unchanged = previous is not None and previous["mtimes"] == mtimes
+    if unchanged and dest is not None:
+        # the files placed by the previous build may have been removed from the dataset since,
+        # or have been placed with another link mode
+        unchanged = previous.get("link_mode") == mode and all(
+            os.path.exists(join(dest, os.path.basename(path))) for field, path in files.items() if field not in PARSERS)
+    if unchanged:
+        # the statistics depend on the depth upper bound they were computed with
+        if maxvalue is None or ("stats" in previous and previous.get("maxvalue") == maxvalue):
+            return key, previous, None
+        return key, dict(previous, stats=frame_stats(files, maxvalue), maxvalue=maxvalue), None
+    record = {}
+    counts = {}
+    names = set()
+    for field, path in files.items():
+        if field in PARSERS:
+            record[field] = PARSERS[field](path)
+            continue
+        name = os.path.basename(path)
+        record[field] = name
+        # the fields of a multilayer render share its file
+        if dest is not None and name not in names:
+            used = link_file(path, join(dest, name), mode)
+            counts[used] = counts.get(used, 0) + 1
+            names.add(name)
+    entry = {"mtimes": mtimes, "record": record}
+    if dest is not None:
+        entry["link_mode"] = mode
+    if maxvalue is not None:
+        entry["stats"] = frame_stats(files, maxvalue)
+        entry["maxvalue"] = maxvalue
+    return key, entry, counts
+
+
+def build(data_path, dest, fields, workers=8, link_mode="copy", manifest=None, place=True, progress=True,
+          stats_maxvalue=None):
+    """Build the records of the complete frames of a render output on a process pool
+
+    Args:
+        data_path (str): The render output directory
+        dest (str): The dataset directory
+        fields (dict): The FrameIndex fields, as returned by get_fields
+        workers (int): Number of processes
+        link_mode (str): One of LINK_MODES
+        manifest (dict): The manifest of the last build, its unchanged frames are kept
+        place (bool): Place the files of the frames in dest
+        progress (bool): Show a progress bar
+        stats_maxvalue (float): Compute the statistics of the frames, with this depth upper bound
+
+    Returns:
+        tuple: (manifest of the frames, source files of each frame, number of new or changed
+        frames, number of files per link mode used, the FrameIndex)
+    """
+    if link_mode not in LINK_MODES:
+        raise ValueError(f"unknown link mode {link_mode}, use one of {', '.join(LINK_MODES)}")
+    manifest = manifest or {}
+    index = FrameIndex(data_path, fields)
+    frames = {}
+    sources = {}
+    updated = 0
+    counts = {}
+
+    def jobs():
+        for batch, frame, files in index:
+            key = frame_key(batch, frame)
+            sources[key] = [path for field, path in files.items() if field not in PARSERS]
+            yield key, files, manifest.get(key), dest if place else None, link_mode, stats_maxvalue
+
+    with ProcessPoolExecutor(max(1, workers)) as pool:
+        for key, entry, used in tqdm(pool.map(build_frame, jobs(), chunksize=32), disable=not progress):
+            frames[key] = entry
+            if used is not None:
+                updated += 1
+                for mode, count in used.items():
+                    counts[mode] = counts.get(mode, 0) + count
+    return frames, sources, updated, counts, index
+
+
+def split_keys(keys, step):
+    splits = {"train": [], "test": []}
+    for key in sorted(keys):
+        batch, frame = map(int, key.split("_"))
+        splits["test" if is_test(batch, frame, step) else "train"].append(key)
+    return splits
+
+
+def write_dataset(dest, frames, splits, stats=False):
+    # the manifest, the records of each split and their statistics
+    save_manifest(dest, frames)
+    for split, keys in splits.items():
+        with open(join(dest, f"{split}.json"), "w") as f:
+            json.dump([frames[key]["record"] for key in keys], f)
+    if stats:
+        write_stats(dest, frames, splits)
+
+
+def write_stats(dest, frames, splits):
+    stats = {split: reduce_stats(frames[key]["stats"] for key in keys).summary() for split, keys in splits.items()}
+    with open(join(dest, STATS), "w") as f:
+        json.dump(stats, f, indent=2)
+
+
+def wait_for_frames(data_path, interval):
+    # wait for the first frame of the render, the passes it has give the fields
+    while not (os.path.isdir(data_path) and any(parse_name(name) for name in os.listdir(data_path))):
+        time.sleep(interval)
+    time.sleep(interval)
+
+
+def follow(data_path, dest, fields, opt, manifest):
+    """Build the dataset while render.py writes the output
+
+    The frames are read from the manifest.jsonl journal of the output as render.py commits
+    them, frames rendered again included, or from scans of the directory for outputs without
+    one. The dataset files are written after each poll with new frames, until no frame came
+    for opt.idle seconds or on ctrl-c
+
+    Args:
+        data_path (str): The render output directory
+        dest (str): The dataset directory
+        fields (dict): The FrameIndex fields, as returned by get_fields
+        opt (Namespace): The command line options
+        manifest (dict): The manifest of the last build, its unchanged frames are kept
+    """
+    index = FrameIndex(data_path, fields)
+    journal = FrameJournal(data_path)
+    use_journal = journal.exists()
+    print("following " + (journal.path if use_journal else f"{data_path}, no journal, scanning the directory"))
+    stats_maxvalue = opt.maxvalue if opt.stats else None
+    frames = {}
+    pending = {}
+    updated = 0
+    last = time.time()
+
+    def ready_frames():
+        # the frames complete since the last poll, (key, files)
+        if not use_journal:
+            return [(frame_key(batch, frame), files) for batch, frame, files in index
+                    if frame_key(batch, frame) not in frames]
+        ready = {}
+        for record in journal.read():
+            key = frame_key(record["batch"], record["frame"])
+            files = pending.setdefault(key, {})
+            for name in record["files"]:
+                parsed = parse_name(name)
+                if parsed is not None and parsed[2:] in index.wanted:
+                    files[parsed[2:]] = join(data_path, name)
+            resolved = index.resolve(files)
+            if resolved is not None:
+                ready[key] = resolved
+        return list(ready.items())
+
+    with ProcessPoolExecutor(max(1, opt.workers)) as pool:
+        try:
+            while True:
+                ready = ready_frames()
+                if ready:
+                    jobs = [(key, files, frames.get(key, manifest.get(key)), dest, opt.link_mode, stats_maxvalue)
+                            for key, files in ready]
+                    for key, entry, used in pool.map(build_frame, jobs):
+                        frames[key] = entry
+                        updated += used is not None
+                    write_dataset(dest, frames, split_keys(frames, opt.test_step), opt.stats)
+                    print(f"{len(frames)} frames, {updated} new or changed")
+                    last = time.time()
+                elif time.time() - last > opt.idle:
+                    break
+                time.sleep(opt.interval)
+        except KeyboardInterrupt:
+            pass
+    write_dataset(dest, frames, split_keys(frames, opt.test_step), opt.stats)
+
+
+def benchmark(data_path, fields, link_mode, max_workers):
+    # frames per second of a full build into scratch directories, by number of processes
+    counts = sorted({n for n in [1, 2, 4, 8, 16, 32, 64] if n < max_workers} | {max_workers})
+    print("{0:>8} {1:>9} {2:>9} {3:>8}".format("workers", "seconds", "frames/s", "speedup"))
+    base = None
+    for workers in counts:
+        scratch = tempfile.mkdtemp(prefix="dataset_")
+        try:
+            ti = time.time()
+            frames, _, _, _, _ = build(data_path, scratch, fields, workers, link_mode, progress=False)
+            seconds = time.time() - ti
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+        base = base or seconds
+        print("{0:8} {1:9.3f} {2:9.1f} {3:8.2f}".format(workers, seconds, len(frames) / seconds, base / seconds))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="dataset tree structure")
+    parser.add_argument("dest", type=str, default="bdataset")
+    parser.add_argument("--type", type=str, default="auto", choices=TYPES,
+                        help="render type of the output, auto detects it from the file names")
+    parser.add_argument("--source", type=str, default="out", help="render output directory, in the working directory")
+    parser.add_argument("--test-step", type=int, default=3, help="one frame in this many goes to the test split")
+    parser.add_argument("--link-mode", type=str, default="copy", choices=LINK_MODES,
+                        help="how the files are placed in the dataset, links fall back to copies")
+    parser.add_argument("--workers", type=int, default=8, help="frames processed in parallel")
+    parser.add_argument("--rebuild", action="store_true", help="process every frame again, not only the new or changed ones")
+    parser.add_argument("--shard-size", type=int, default=0,
+                        help="export tar shards of this many samples instead of a directory of files")
+    parser.add_argument("--shuffle", type=int, default=None, metavar="SEED",
+                        help="shuffle the samples into the shards and the shard order with this seed")
+    parser.add_argument("--stats", action="store_true",
+                        help="compute the statistics of each split in the same pass and write them to stats.json")
+    parser.add_argument("--maxvalue", type=float, default=80, help="upper bound of the depth histogram")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="measure the build time by number of workers in scratch directories instead")
+    parser.add_argument("--follow", action="store_true",
+                        help="build the frames as render.py commits them, until no frame came for --idle seconds")
+    parser.add_argument("--interval", type=float, default=5, help="seconds between two polls of the output when following")
+    parser.add_argument("--idle", type=float, default=600, help="seconds without new frames before following stops")
+    opt = parser.parse_args(args)
+    if opt.follow and (opt.shard_size or opt.benchmark):
+        parser.error("--follow builds a directory of files, it can't be used with --shard-size or --benchmark")
+
+    DATASET = opt.dest
+    wd = Path(getcwd())
+    root = wd.parent
+    data_path = Path(join(wd, opt.source))
+    dest = join(root, DATASET)
+
+    if opt.follow:
+        wait_for_frames(data_path, opt.interval)
+    passes = scan_passes(data_path)
+    render_type = detect_type(passes) if opt.type == "auto" else opt.type
+    fields = get_fields(passes, render_type)
+    print(f"{render_type} render, fields: {', '.join(fields)}")
+
+    if opt.benchmark:
+        benchmark(data_path, fields, opt.link_mode, opt.workers)
+        return
+
+    Path(dest).mkdir(parents=True, exist_ok=True)
+
+    # frames whose files have the same mtimes as in the last build are not processed again.
+    # shards are always packed again with every frame
+    manifest = {} if opt.rebuild or opt.shard_size else load_manifest(dest)
+    if opt.follow:
+        follow(data_path, dest, fields, opt, manifest)
+        return
+    frames, sources, updated, counts, index = build(
+        data_path, dest, fields, opt.workers, opt.link_mode, manifest, place=not opt.shard_size,
+        stats_maxvalue=opt.maxvalue if opt.stats else None)
+    report_incomplete(index.incomplete)
+    splits = split_keys(frames, opt.test_step)
+
+    if opt.shard_size:
+        samples = {split: [(key, frames[key]["record"], sources[key]) for key in keys] for split, keys in splits.items()}
+        shards = export_shards(dest, samples, opt.shard_size, opt.workers, opt.shuffle)
+        print(", ".join(f"{split} {len(split_shards)} shards" for split, split_shards in shards.items()))
+        if opt.stats:
+            write_stats(dest, frames, splits)
+        return
+
+    print(f"{len(frames)} frames, {updated} new or changed")
+    if counts:
+        print(", ".join(f"{count} {mode}" for mode, count in counts.items()))
+    write_dataset(dest, frames, splits, opt.stats)
+
+
+if __name__ == "__main__":
+    main()
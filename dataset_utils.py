@@ -0,0 +1,332 @@
+import io
+import os
+import re
+import json
+import zlib
+import errno
+import random
+import shutil
+import tarfile
+import collections
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
+
+import exr
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# <batch>_<frame><pass>[_<view>].<ext>, the files written by render.py
+SEARCH_FILE = re.compile(r"^(\d{4})_(\d{6})([a-z]+)(?:_([LR]))?\.(\w+)$")
+LINK_MODES = ["copy", "hardlink", "reflink", "symlink"]
+# the frames already in a dataset and the mtimes of their files, kept in the dataset directory
+DATASET_MANIFEST = "manifest.json"
+# the frames render.py committed to its output, a json line per frame
+RENDER_MANIFEST = "manifest.jsonl"
+# the shards of each split and the samples they hold
+SHARD_INDEX = "shards.json"
+# linux ioctl cloning a whole file, supported by btrfs, xfs and others
+FICLONE = 0x40049409
+# errors meaning the link is not possible here, the file is copied instead
+FALLBACK_ERRORS = {errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EMLINK, errno.ENOSYS}
+
+
+def reflink(src, dst):
+    # copy on write clone of src, the data is shared until one of them is written
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "reflinks are not supported on this platform", dst)
+    with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+        try:
+            fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+        except OSError:
+            f_dst.close()
+            os.remove(dst)
+            raise
+
+
+def link_file(src, dst, mode="copy"):
+    """Place src at dst by copying or linking it, replacing dst
+
+    Args:
+        src (str): The file to link
+        dst (str): Its path in the dataset
+        mode (str): One of LINK_MODES. Hardlinks and reflinks fall back to a copy when the
+            filesystem can't make them, e.g. across devices
+
+    Returns:
+        str: the mode actually used
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        if mode == "hardlink":
+            os.link(src, dst)
+            return mode
+        if mode == "reflink":
+            reflink(src, dst)
+            return mode
+        if mode == "symlink":
+            os.symlink(os.path.abspath(src), dst)
+            return mode
+    except OSError as e:
+        if e.errno not in FALLBACK_ERRORS:
+            raise
+    shutil.copy(src, dst)
+    return "copy"
+
+
+def parse_name(name):
+    # (batch, frame, pass, view) of an output file name, view is None for single view
+    # renders. None for files that are not part of a frame
+    match = SEARCH_FILE.match(name)
+    if match is None:
+        return None
+    batch, frame, name, view, _ = match.groups()
+    return int(batch), int(frame), name, view
+
+
+def bounded_map(pool, fn, jobs, window):
+    # pool.map in order, with at most window jobs submitted and not yet consumed
+    pending = collections.deque()
+    for job in jobs:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(pool.submit(fn, job))
+    while pending:
+        yield pending.popleft().result()
+
+
+class FrameIndex():
+    """Streaming index of the frames of a render output
+
+    Iterating scans the directory once and yields (batch, frame, files) for every frame as
+    soon as it has the first choice file of each field, files being a dict field -> path. The
+    frames only complete with other candidates, e.g. the multilayer file instead of a pass
+    rendered again on its own, are yielded once the scan ends. Only the files of the frames
+    not yielded yet are kept in memory, the yielded frames are a bit each. Once done,
+    incomplete maps the (batch, frame) of the frames that never got complete to their missing
+    fields
+
+    Args:
+        path (str): The render output directory
+        fields (dict): record field to the (pass, view) of its file, or a list of them in
+            order of preference, e.g. a pass or the multilayer file holding it
+    """
+
+    def __init__(self, path, fields):
+        self.path = path
+        self.fields = {field: candidates if isinstance(candidates, list) else [candidates]
+                       for field, candidates in fields.items()}
+        self.wanted = {candidate for candidates in self.fields.values() for candidate in candidates}
+        self.incomplete = {}
+
+    def resolve(self, files, fallback=True):
+        # the record of the files of a frame, None while a field has none of its candidates,
+        # or not its first one without fallback
+        record = {}
+        for field, candidates in self.fields.items():
+            found = next((files[c] for c in (candidates if fallback else candidates[:1]) if c in files), None)
+            if found is None:
+                return None
+            record[field] = found
+        return record
+
+    def missing(self, files):
+        return [field for field, candidates in self.fields.items() if not any(c in files for c in candidates)]
+
+    def __iter__(self):
+        pending = {}
+        # batch -> bitmap of its yielded frames, the later files of a frame are skipped
+        done = {}
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                key = parse_name(entry.name)
+                if key is None or key[2:] not in self.wanted:
+                    continue
+                batch, frame = key[:2]
+                bitmap = done.get(batch, b"")
+                if frame >> 3 < len(bitmap) and bitmap[frame >> 3] & (1 << (frame & 7)):
+                    continue
+                files = pending.setdefault(key[:2], {})
+                files[key[2:]] = entry.path
+                record = self.resolve(files, fallback=False)
+                if record is not None:
+                    del pending[key[:2]]
+                    bitmap = done.setdefault(batch, bytearray())
+                    if frame >> 3 >= len(bitmap):
+                        bitmap.extend(bytes((frame >> 3) + 1 - len(bitmap)))
+                    bitmap[frame >> 3] |= 1 << (frame & 7)
+                    yield batch, frame, record
+        self.incomplete = {}
+        for key, files in sorted(pending.items()):
+            record = self.resolve(files)
+            if record is None:
+                self.incomplete[key] = self.missing(files)
+            else:
+                yield key[0], key[1], record
+
+
+def scan_passes(path):
+    """The passes of a render output and the files holding them
+
+    Scans the file names once, and the header of one multilayer file per view for its layers
+
+    Args:
+        path (str): The render output directory
+
+    Returns:
+        dict: (pass, view) to the FrameIndex candidates reading it, its own files and/or
+        the multilayer files holding it as a layer
+    """
+    present = set()
+    layers = {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            key = parse_name(entry.name)
+            if key is None:
+                continue
+            present.add(key[2:])
+            if key[2] == "layers" and key[3] not in layers:
+                layers[key[3]] = entry.path
+
+    in_layers = set()
+    for view, layers_path in layers.items():
+        with open(layers_path, 'rb') as f:
+            header, _ = exr.read_header(f.read(1 << 16))
+        for name, _ in header["channels"]:
+            in_layers.add((exr.split_channel(name)[0].split('.')[0], view))
+
+    passes = {key: [key] for key in present if key[0] != "layers"}
+    for key in in_layers:
+        passes.setdefault(key, []).append(("layers", key[1]))
+    return passes
+
+
+class FrameJournal():
+    """Reads the frames render.py commits to the manifest.jsonl of its output as they are appended
+
+    Args:
+        path (str): The render output directory
+    """
+
+    def __init__(self, path):
+        self.path = os.path.join(path, RENDER_MANIFEST)
+        self.offset = 0
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def read(self):
+        # the records appended since the last call, a line still being written is read next time
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+        except OSError:
+            return []
+        end = data.rfind(b'\n') + 1
+        self.offset += end
+        records = []
+        for line in data[:end].splitlines():
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+        return records
+
+
+def report_incomplete(incomplete, limit=10):
+    if not incomplete:
+        return
+    print(f"{len(incomplete)} incomplete frames skipped")
+    for (batch, frame), fields in list(incomplete.items())[:limit]:
+        print(f"  batch {batch} frame {frame}: missing {', '.join(fields)}")
+
+
+def frame_key(batch, frame):
+    return "%04d_%06d" % (batch, frame)
+
+
+def is_test(batch, frame, step=3):
+    # one frame in step goes to the test split, by hash of its key so it never changes split
+    return zlib.crc32(frame_key(batch, frame).encode('utf-8')) % step == 0
+
+
+def file_mtimes(files):
+    return {field: os.stat(path).st_mtime_ns for field, path in files.items()}
+
+
+def load_manifest(dest):
+    # frame key -> {"mtimes": mtimes of its source files, "record": its dataset record}
+    try:
+        with open(os.path.join(dest, DATASET_MANIFEST), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(dest, frames):
+    path = os.path.join(dest, DATASET_MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(frames, f)
+    os.replace(path + '.tmp', path)
+
+
+def write_shard(path, samples):
+    """Write samples to a tar shard, WebDataset style
+
+    The files of a sample are stored next to each other as <key>.<pass>[_<view>].<ext>,
+    followed by <key>.json with its record
+
+    Args:
+        path (str): The shard path, written atomically
+        samples (list): (key, record, source paths) of the samples
+    """
+    with tarfile.open(path + '.tmp', 'w') as tar:
+        for key, record, paths in samples:
+            for source in dict.fromkeys(paths):
+                tar.add(source, arcname=f"{key}.{os.path.basename(source)[len(key):]}")
+            data = json.dumps(record).encode('utf-8')
+            info = tarfile.TarInfo(f"{key}.json")
+            info.size = len(data)
+            info.mtime = os.path.getmtime(paths[0]) if paths else 0
+            tar.addfile(info, io.BytesIO(data))
+    os.replace(path + '.tmp', path)
+
+
+def export_shards(dest, splits, shard_size=1000, workers=8, seed=None):
+    """Pack the samples of each split in tar shards written in parallel, and index them
+
+    Args:
+        dest (str): The dataset directory, shards are named <split>-<number>.tar
+        splits (dict): split name to its samples, (key, record, source paths)
+        shard_size (int): Samples per shard, the last one holds the rest
+        workers (int): Number of threads writing shards, the writes are bound by the disks
+        seed (int): Shuffle the samples into the shards and the shard order of the index
+            with this seed, None keeps them in key order
+    """
+    index = {}
+    with ThreadPoolExecutor(max(1, workers)) as pool:
+        jobs = []
+        for split, samples in splits.items():
+            samples = list(samples)
+            if seed is not None:
+                random.Random(seed).shuffle(samples)
+            shards = []
+            for start in range(0, len(samples), shard_size):
+                name = "%s-%06d.tar" % (split, start // shard_size)
+                chunk = samples[start:start + shard_size]
+                jobs.append(pool.submit(write_shard, os.path.join(dest, name), chunk))
+                shards.append({"name": name, "samples": len(chunk), "keys": [key for key, _, _ in chunk]})
+            if seed is not None:
+                random.Random(seed).shuffle(shards)
+            index[split] = shards
+        for job in tqdm(as_completed(jobs), total=len(jobs), desc="shards"):
+            job.result()
+
+    with open(os.path.join(dest, SHARD_INDEX), 'w') as f:
+        json.dump(index, f)
+    return index
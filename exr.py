@@ -0,0 +1,276 @@
+# Minimal OpenEXR reader in numpy for the files written by render.py, including the
+# multilayer EXRs. Supports single part scanline images compressed with NONE, RLE, ZIPS or
+# ZIP, the codecs blender writes by default. Other codecs raise a ValueError.
+# write_exr writes the same kind of files, uncompressed or with ZIPS/ZIP.
+
+import mmap
+import zlib
+import struct
+import numpy as np
+
+
+MAGIC = 20000630
+TILED_FLAG = 0x200
+MULTIPART_FLAG = 0x1000
+
+COMPRESSIONS = ["NONE", "RLE", "ZIPS", "ZIP", "PIZ", "PXR24", "B44", "B44A", "DWAA", "DWAB"]
+LINES_PER_CHUNK = {"NONE": 1, "RLE": 1, "ZIPS": 1, "ZIP": 16}
+PIXEL_TYPES = [np.dtype('<u4'), np.dtype('<f2'), np.dtype('<f4')]
+PRECISIONS = {"half": np.dtype('<f2'), "float": np.dtype('<f4')}
+WRITE_COMPRESSIONS = ["NONE", "ZIPS", "ZIP"]
+
+# order of the channels of a layer, anything else is appended alphabetically
+CHANNEL_ORDER = ["R", "G", "B", "A", "X", "Y", "Z", "W", "V"]
+
+
+def read_cstring(data, offset):
+    end = data.find(b'\0', offset)
+    return data[offset:end].decode('utf-8'), end + 1
+
+
+def parse_channels(value):
+    channels = []
+    offset = 0
+    while value[offset] != 0:
+        name, offset = read_cstring(value, offset)
+        pixel_type, _, x_sampling, y_sampling = struct.unpack_from('<iB3xii', value, offset)
+        offset += 16
+        if x_sampling != 1 or y_sampling != 1:
+            raise ValueError(f"subsampled channel {name} is not supported")
+        channels.append((name, PIXEL_TYPES[pixel_type]))
+    return channels
+
+
+def read_header(data):
+    # parse the header of a single part scanline EXR, returns the header and the data offset
+    magic, version = struct.unpack_from('<ii', data, 0)
+    if magic != MAGIC:
+        raise ValueError("not an OpenEXR file")
+    if version & (TILED_FLAG | MULTIPART_FLAG):
+        raise ValueError("tiled and multipart EXR files are not supported")
+
+    header = {}
+    offset = 8
+    while data[offset] != 0:
+        name, offset = read_cstring(data, offset)
+        attribute_type, offset = read_cstring(data, offset)
+        size, = struct.unpack_from('<i', data, offset)
+        value = bytes(data[offset + 4:offset + 4 + size])
+        offset += 4 + size
+        if attribute_type == "chlist":
+            header[name] = parse_channels(value)
+        elif attribute_type == "compression":
+            header[name] = COMPRESSIONS[value[0]]
+        elif attribute_type == "box2i":
+            header[name] = struct.unpack('<iiii', value)
+        else:
+            header[name] = value
+    return header, offset + 1
+
+
+def undo_predictor(data):
+    # the zip and rle codecs store byte deltas of the two halves of the interleaved data
+    data = np.frombuffer(data, dtype=np.uint8).copy()
+    data[1:] -= 128
+    data = np.cumsum(data, dtype=np.uint8)
+    out = np.empty_like(data)
+    half = (data.size + 1) // 2
+    out[0::2] = data[:half]
+    out[1::2] = data[half:]
+    return out.tobytes()
+
+
+def apply_predictor(data):
+    # inverse of undo_predictor
+    data = np.frombuffer(data, dtype=np.uint8)
+    data = np.concatenate((data[0::2], data[1::2]))
+    out = data.copy()
+    out[1:] = data[1:] - data[:-1] + 128
+    return out.tobytes()
+
+
+def decompress_rle(data):
+    out = bytearray()
+    offset = 0
+    while offset < len(data):
+        count = struct.unpack_from('<b', data, offset)[0]
+        offset += 1
+        if count < 0:
+            out += data[offset:offset - count]
+            offset -= count
+        else:
+            out += data[offset:offset + 1] * (count + 1)
+            offset += 1
+    return bytes(out)
+
+
+def decompress(compression, data, size):
+    # blocks that would not get smaller are stored uncompressed
+    if compression == "NONE" or len(data) == size:
+        return data
+    if compression in ("ZIP", "ZIPS"):
+        return undo_predictor(zlib.decompress(data))
+    if compression == "RLE":
+        return undo_predictor(decompress_rle(data))
+    raise ValueError(f"EXR compression {compression} is not supported")
+
+
+def compress(compression, data):
+    if compression in ("ZIP", "ZIPS"):
+        block = zlib.compress(apply_predictor(data))
+        return block if len(block) < len(data) else data
+    return data
+
+
+def line_dtype(channels, width):
+    # the pixels of one scanline, channel after channel
+    return np.dtype([(name, dtype, (width,)) for name, dtype in channels])
+
+
+def read_exr(path, use_mmap=True):
+    """Read the channels of an EXR file
+
+    Args:
+        path (str): The path to the file
+        use_mmap (bool): Map the file instead of reading it
+
+    Returns:
+        dict: channel name to a (height, width) array. For uncompressed files the arrays
+        are views over the file without any copy
+    """
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if use_mmap else f.read()
+
+    header, offset = read_header(data)
+    channels = header["channels"]
+    compression = header.get("compression", "NONE")
+    if compression not in LINES_PER_CHUNK:
+        raise ValueError(f"EXR compression {compression} is not supported")
+    x_min, y_min, x_max, y_max = header["dataWindow"]
+    width, height = x_max - x_min + 1, y_max - y_min + 1
+    lines = line_dtype(channels, width)
+    lines_per_chunk = LINES_PER_CHUNK[compression]
+    num_chunks = -(-height // lines_per_chunk)
+    offsets = np.frombuffer(data, dtype='<u8', count=num_chunks, offset=offset).astype(np.int64)
+
+    # uncompressed lines written in order are a fixed size record, view them directly
+    chunk_size = 8 + lines.itemsize
+    if compression == "NONE" and np.all(np.diff(offsets) == chunk_size):
+        chunk = np.dtype([("y", '<i4'), ("size", '<i4')] + [(n, lines.fields[n][0]) for n in lines.names])
+        pixels = np.frombuffer(data, dtype=chunk, count=height, offset=int(offsets[0]))
+        if np.all(pixels["size"] == lines.itemsize):
+            order = np.argsort(pixels["y"], kind='stable')
+            if np.all(order == np.arange(height)):
+                return {name: pixels[name] for name, _ in channels}
+            return {name: pixels[name][order] for name, _ in channels}
+
+    buffer = bytearray(lines.itemsize * height)
+    for chunk_offset in offsets:
+        y, size = struct.unpack_from('<ii', data, chunk_offset)
+        first = y - y_min
+        count = min(lines_per_chunk, height - first)
+        block = decompress(compression, bytes(data[chunk_offset + 8:chunk_offset + 8 + size]),
+                           lines.itemsize * count)
+        buffer[first * lines.itemsize:(first + count) * lines.itemsize] = block
+    pixels = np.frombuffer(bytes(buffer), dtype=lines, count=height)
+    return {name: pixels[name] for name, _ in channels}
+
+
+def split_channel(name):
+    layer, _, channel = name.rpartition('.')
+    return layer, channel
+
+
+def channel_key(channel):
+    return (CHANNEL_ORDER.index(channel), channel) if channel in CHANNEL_ORDER else (len(CHANNEL_ORDER), channel)
+
+
+def group_layers(channels):
+    """Group the channels of an EXR file by layer
+
+    Args:
+        channels (dict): channel name to a (height, width) array, as returned by read_exr
+
+    Returns:
+        dict: layer name to a (height, width, channels) array, channels ordered RGBA, XYZW.
+        The channels of a single layer file are under the empty name
+    """
+    layers = {}
+    for name in channels:
+        layer, channel = split_channel(name)
+        layers.setdefault(layer, []).append(channel)
+    return {layer: np.stack([channels[f"{layer}.{c}" if layer else c] for c in sorted(names, key=channel_key)], axis=-1)
+            for layer, names in layers.items()}
+
+
+def read_layers(path):
+    return group_layers(read_exr(path))
+
+
+def read_layer(path, layer):
+    """Read one layer of a multilayer EXR file
+
+    Args:
+        path (str): The path to the file
+        layer (str): The layer name, e.g. depth. Layers nested under it (view names) match too
+
+    Returns:
+        ndarray: Returns an array with the shape HxWxC
+    """
+    channels = read_exr(path)
+    names = [n for n in channels if split_channel(n)[0] == layer]
+    if not names:
+        names = [n for n in channels if split_channel(n)[0].startswith(layer + '.')]
+    if not names:
+        raise KeyError(f"layer {layer} not found in {path}")
+    return next(iter(group_layers({n: channels[n] for n in names}).values()))
+
+
+def pack_attribute(name, attribute_type, value):
+    return name.encode('utf-8') + b'\0' + attribute_type.encode('utf-8') + b'\0' + struct.pack('<i', len(value)) + value
+
+
+def write_exr(path, channels, compression="ZIP", precision="half"):
+    """Write a single part scanline EXR file
+
+    Args:
+        path (str): The path to the file
+        channels (dict): channel name to a (height, width) array, top row first
+        compression (str): NONE, ZIPS or ZIP
+        precision (str): half or float
+    """
+    if compression not in WRITE_COMPRESSIONS:
+        raise ValueError(f"EXR compression {compression} is not supported")
+    dtype = PRECISIONS[precision]
+    names = sorted(channels)
+    height, width = channels[names[0]].shape
+
+    chlist = b''.join(name.encode('utf-8') + b'\0' + struct.pack('<iB3xii', PIXEL_TYPES.index(dtype), 0, 1, 1)
+                      for name in names) + b'\0'
+    window = struct.pack('<iiii', 0, 0, width - 1, height - 1)
+    header = struct.pack('<ii', MAGIC, 2) + b''.join([
+        pack_attribute("channels", "chlist", chlist),
+        pack_attribute("compression", "compression", bytes([COMPRESSIONS.index(compression)])),
+        pack_attribute("dataWindow", "box2i", window),
+        pack_attribute("displayWindow", "box2i", window),
+        pack_attribute("lineOrder", "lineOrder", b'\0'),
+        pack_attribute("pixelAspectRatio", "float", struct.pack('<f', 1)),
+        pack_attribute("screenWindowCenter", "v2f", struct.pack('<ff', 0, 0)),
+        pack_attribute("screenWindowWidth", "float", struct.pack('<f', 1)),
+    ]) + b'\0'
+
+    lines = np.empty(height, dtype=line_dtype([(name, dtype) for name in names], width))
+    for name in names:
+        lines[name] = channels[name]
+    lines_per_chunk = LINES_PER_CHUNK[compression]
+    chunks = []
+    for y in range(0, height, lines_per_chunk):
+        block = compress(compression, lines[y:y + lines_per_chunk].tobytes())
+        chunks.append(struct.pack('<ii', y, len(block)) + block)
+
+    offsets = len(header) + 8 * len(chunks) + np.cumsum([0] + [len(chunk) for chunk in chunks[:-1]])
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write(offsets.astype('<u8').tobytes())
+        for chunk in chunks:
+            f.write(chunk)
@@ -0,0 +1,217 @@
+# Contact sheets of a render output for QA, a png per batch with a row per sampled frame and a
+# column per pass: rgb with the boxes of its labels, depth, normal, albedo, flow, ... and the top
+# view of the voxelized meshes. The PreviewData.ipynb helpers are vectorized here and the
+# frames are decoded on a process pool.
+# python preview.py [--source out] [--dest preview] [--frames 8] [--size 256] [--workers 8] [--seed 0]
+
+import os
+import pickle
+import random
+import argparse
+import numpy as np
+import cv2
+from os import getcwd
+from os.path import join
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+
+from dataset import detect_type, get_fields
+from dataset_utils import FrameIndex, bounded_map, scan_passes
+from reader import decode_field, linear2srgb, read_label
+
+
+# fields drawn as a panel, in this order, views after each other
+PANELS = ["image", "depth", "normal", "albedo", "flow", "disparity", "consistency"]
+VOLUME_SIZE = 32
+
+
+def meshes2volume(meshes, map_size=32):
+    """Voxelize the vertices of the meshes of a frame, as meshes2volume of PreviewData.ipynb
+
+    Args:
+        meshes (list): (class, vertices, edges) of each object, as written to mesh.pkl
+        map_size (int): Voxels per axis
+
+    Returns:
+        ndarray: (map_size, map_size, map_size) class + 1 of each voxel, the highest class
+        when objects share a voxel, 0 for empty voxels
+    """
+    volume = np.zeros((map_size, map_size, map_size), dtype=np.int64)
+    meshes = [(c, np.asarray(vs, dtype=np.float64).reshape(-1, 3)) for c, vs, _ in meshes]
+    if not meshes:
+        return volume
+    vertices = np.concatenate([vs for _, vs in meshes])
+    classes = np.concatenate([np.full(len(vs), c + 1, dtype=np.int64) for c, vs in meshes])
+    if not len(vertices):
+        return volume
+    voxels = np.floor(vertices * ((map_size - 1) / np.maximum(vertices.max(axis=0), 1))).astype(np.int64)
+    np.maximum.at(volume, (voxels[:, 0], voxels[:, 1], voxels[:, 2]), classes)
+    return volume
+
+
+def hsv2bgr(hue, value):
+    # fully saturated hsv to uint8 bgr, hue and value in [0, 1]
+    k = (np.array([1, 3, 5], dtype=np.float32) + hue[..., None] * 6) % 6
+    return (value[..., None] * (1 - np.clip(np.minimum(k, 4 - k), 0, 1)) * 255).astype(np.uint8)
+
+
+def flow2color(flow):
+    """Color a flow pass like exr2flow, hue for the direction and value for the magnitude
+
+    Args:
+        flow (ndarray): (height, width, channels) pass in blender's channel order, the x and y
+            motion in the first two channels
+
+    Returns:
+        ndarray: (height, width, 3) uint8 BGR
+    """
+    x = flow[..., 0].astype(np.float32)
+    y = -flow[..., 1].astype(np.float32)
+    magnitude = np.hypot(x, y)
+    hue = (np.arctan2(y, x) / (2 * np.pi)) % 1
+    span = magnitude.max() - magnitude.min()
+    value = (magnitude - magnitude.min()) / span if span > 0 else np.zeros_like(magnitude)
+    return hsv2bgr(hue, value)
+
+
+def volume2image(volume, classes=100):
+    # top view of the volume, the class of the highest voxel of each column colored by hue
+    top = volume.max(axis=2).T[::-1]
+    image = hsv2bgr((top % classes) / classes, (top > 0).astype(np.float32))
+    return image
+
+
+def gray(values):
+    # min max normalized single channel to uint8 bgr
+    values = values[..., 0] if values.ndim == 3 else values
+    values = values.astype(np.float32)
+    span = values.max() - values.min()
+    values = (values - values.min()) / span if span > 0 else np.zeros_like(values)
+    return np.repeat((values * 255).astype(np.uint8)[..., None], 3, axis=-1)
+
+
+def draw_boxes(image, labels):
+    # the class x y w h boxes of a label file, normalized to the image size
+    height, width = image.shape[:2]
+    image = np.ascontiguousarray(image)
+    for label in labels:
+        c, x, y, w, h = label
+        color = hsv2bgr(np.array([c / 10 % 1], dtype=np.float32), np.ones(1, dtype=np.float32))[0].tolist()
+        c1 = int((x - w / 2) * width), int((y - h / 2) * height)
+        c2 = int((x + w / 2) * width), int((y + h / 2) * height)
+        cv2.rectangle(image, c1, c2, color, thickness=2, lineType=cv2.LINE_AA)
+        cv2.putText(image, str(int(c)), (c1[0], c1[1] - 2), 0, 0.5, color, thickness=1, lineType=cv2.LINE_AA)
+    return image
+
+
+def render_panel(field, path, maxvalue=80):
+    # the uint8 bgr image of a field, from its file or the .npy array of a numpy capture, both
+    # decoded by the reader
+    name = field.rstrip('LR')
+    if name == "image":
+        return decode_field(field, path)
+    if name == "depth":
+        depth = decode_field(field, path, maxvalue)
+        return np.repeat(((depth + 1) * 127.5).astype(np.uint8), 3, axis=-1)
+    if name == "normal":
+        return ((np.clip(decode_field(field, path), -1, 1) + 1) * 127.5).astype(np.uint8)
+    if name == "albedo":
+        return linear2srgb(decode_field(field, path))
+    if name == "flow":
+        # back to blender's order, the decoder gives opencv's
+        return flow2color(decode_field(field, path)[..., [2, 1, 0]])
+    return gray(decode_field(field, path))
+
+
+def fit(image, size, interpolation=cv2.INTER_AREA):
+    height, width = image.shape[:2]
+    return cv2.resize(image, (max(1, round(width * size / height)), size), interpolation=interpolation)
+
+
+def preview_frame(job):
+    """The row of a frame in its contact sheet
+
+    Args:
+        job (tuple): (files, panels, size, maxvalue), files the FrameIndex record of the frame
+            and panels its fields drawn
+
+    Returns:
+        list: (size, width, 3) uint8 BGR panels, the volume last for frames with meshes
+    """
+    files, panels, size, maxvalue = job
+    row = []
+    boxes = "label" in files
+    for field in panels:
+        image = render_panel(field, files[field], maxvalue)
+        if boxes and field.startswith("image"):
+            # the labels are boxes of the first view
+            image = draw_boxes(image, read_label(files["label"]))
+            boxes = False
+        row.append(fit(image, size))
+    if "mesh" in files:
+        with open(files["mesh"], 'rb') as f:
+            volume = meshes2volume(pickle.load(f), VOLUME_SIZE)
+        row.append(fit(volume2image(volume), size, cv2.INTER_NEAREST))
+    return row
+
+
+def header(names, widths, height=24):
+    # the column names above the rows
+    cells = []
+    for name, width in zip(names, widths):
+        cell = np.zeros((height, width, 3), dtype=np.uint8)
+        cv2.putText(cell, name, (4, height - 7), 0, 0.5, (255, 255, 255), thickness=1, lineType=cv2.LINE_AA)
+        cells.append(cell)
+    return np.concatenate(cells, axis=1)
+
+
+def write_sheet(path, names, rows):
+    # a column is as wide as its widest panel
+    widths = [max(row[column].shape[1] for row in rows) for column in range(len(names))]
+    lines = [header(names, widths)]
+    for row in rows:
+        lines.append(np.concatenate([np.pad(panel, ((0, 0), (0, width - panel.shape[1]), (0, 0)))
+                                     for panel, width in zip(row, widths)], axis=1))
+    cv2.imwrite(path, np.concatenate(lines, axis=0))
+
+
+def sample_frames(records, count, seed=0):
+    # count frames of each batch, in frame order
+    batches = {}
+    for batch, frame, files in records:
+        batches.setdefault(batch, []).append((frame, files))
+    rng = random.Random(seed)
+    return {batch: sorted(rng.sample(frames, min(count, len(frames))), key=lambda item: item[0])
+            for batch, frames in sorted(batches.items())}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="contact sheets of the render output")
+    parser.add_argument("--source", type=str, default="out", help="render output directory")
+    parser.add_argument("--dest", type=str, default="preview", help="directory of the <batch>.png sheets")
+    parser.add_argument("--frames", type=int, default=8, help="frames sampled per batch")
+    parser.add_argument("--size", type=int, default=256, help="height of the panels")
+    parser.add_argument("--maxvalue", type=float, default=80, help="depth clipping distance")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="decoding processes")
+    parser.add_argument("--seed", type=int, default=0)
+    opt = parser.parse_args()
+
+    data_path = join(getcwd(), opt.source)
+    os.makedirs(opt.dest, exist_ok=True)
+    passes = scan_passes(data_path)
+    fields = get_fields(passes, detect_type(passes))
+    panels = [field for name in PANELS for field in fields if field.rstrip('LR') == name]
+    names = panels + (["volume"] if "mesh" in fields else [])
+
+    sheets = sample_frames(FrameIndex(data_path, fields), opt.frames, opt.seed)
+    jobs = [(files, panels, opt.size, opt.maxvalue) for frames in sheets.values() for _, files in frames]
+    workers = max(1, opt.workers)
+    with ProcessPoolExecutor(workers) as pool:
+        # a sheet is written once its rows are in and then released
+        rows = bounded_map(pool, preview_frame, jobs, 2 * workers)
+        with tqdm(total=len(jobs)) as progress:
+            for batch, frames in sheets.items():
+                batch_rows = [next(rows) for _ in frames]
+                progress.update(len(frames))
+                write_sheet(join(opt.dest, "%04d.png" % batch), names, batch_rows)
+    print(f"{len(sheets)} sheets, {len(jobs)} frames in {opt.dest}")
@@ -0,0 +1,258 @@
+# Random access reader for the datasets written by dataset.py. A sample
+# is the record of a frame with its files decoded like the PreviewData.ipynb helpers: images
+# as uint8 BGR, depth clipped and scaled to [-1, 1], normals * 2 - 1, labels as an array of
+# class x y w h rows, the .npy passes of numpy captures included. Passes decoded by
+# tensors.py are read as views over its memory mapped arrays instead, without any copy.
+# python reader.py bdataset [--split train] [--batch-size 32] [--workers 8] [--samples 1024]
+
+import os
+import json
+import time
+import pickle
+import random
+import argparse
+import threading
+import collections
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import exr
+from dataset_utils import parse_name
+from tensors import TENSOR_INDEX
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+LAYERS_LABEL = "layers"
+# multilayer layer holding the image of a field, named after its pass
+IMAGE_LAYERS = {"image": "rgb", "imageL": "stereo", "imageR": "stereo"}
+# fields whose captured arrays are converted like their files, the others are read as they are
+NPY_DECODED = ["image", "depth", "normal", "albedo", "flow"]
+
+
+def read_png(path):
+    if cv2 is None:
+        raise ImportError("reading png images requires opencv (cv2)")
+    return cv2.imread(path)
+
+
+def linear2srgb(rgb):
+    # the rgb layer of a multilayer file is linear, as the png would be after the view transform
+    rgb = np.clip(rgb, 0, 1)
+    rgb = np.where(rgb <= 0.0031308, rgb * 12.92, 1.055 * rgb ** (1 / 2.4) - 0.055)
+    return (rgb * 255 + 0.5).astype(np.uint8)
+
+
+def read_pixels(path, layer, alpha=False):
+    # the channels of a pass in the order opencv reads them, from its file, the multilayer file
+    # or the array of a captured layer, memory mapped
+    if path.endswith(".npy"):
+        pixels = np.load(path, mmap_mode='r')
+    elif parse_name(os.path.basename(path))[2] == LAYERS_LABEL:
+        pixels = exr.read_layer(path, layer)
+    else:
+        pixels = next(iter(exr.read_layers(path).values()))
+    if pixels.shape[-1] < 3:
+        return pixels
+    return pixels[..., [2, 1, 0, 3]] if alpha and pixels.shape[-1] == 4 else pixels[..., 2::-1]
+
+
+def read_label(path):
+    # class x y w h rows, as txt2label
+    with open(path, 'r') as f:
+        return np.array([line.split() for line in f.read().strip().splitlines()], dtype=np.float32).reshape(-1, 5)
+
+
+def decode_field(field, path, maxvalue=80):
+    """Decode the file of a record field
+
+    Args:
+        field (str): The record field, e.g. image, depthL
+        path (str): The file of the field in the dataset
+        maxvalue (float): depth clipping distance
+
+    Returns:
+        images (height, width, 3) uint8 BGR, depth (height, width, 1), normal and albedo
+        (height, width, 3), flow (height, width, 4) and disparity float32 arrays, consistency
+        masks (height, width) uint8, the meshes of pkl2meshes and the instances json. The
+        captured .npy passes are decoded the same way, the ones needing no conversion (e.g.
+        disparity) are returned memory mapped in the captured dtype
+    """
+    name = field.rstrip('LR')
+    if path.endswith(".npy") and name not in NPY_DECODED:
+        return np.load(path, mmap_mode='r')
+    if name == "image":
+        if path.endswith(".png"):
+            return read_png(path)
+        return linear2srgb(read_pixels(path, IMAGE_LAYERS[field]))
+    if name == "depth":
+        depth = read_pixels(path, "depth")[..., :1]
+        return (np.minimum(depth, maxvalue) / maxvalue * 2 - 1).astype(np.float32)
+    if name == "normal":
+        return (read_pixels(path, "normal") * 2 - 1).astype(np.float32)
+    if name in ("albedo", "flow", "disparity"):
+        return read_pixels(path, name, alpha=name == "flow").astype(np.float32)
+    if name == "consistency":
+        if cv2 is None:
+            raise ImportError("reading png images requires opencv (cv2)")
+        return cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if name == "mesh":
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    if name == "instances":
+        with open(path, 'r') as f:
+            return json.load(f)
+    if name == "label" or path.endswith(".txt"):
+        return read_label(path)
+    raise ValueError(f"no decoder for the {field} field")
+
+
+class LRUCache():
+    """Thread safe least recently used cache of decoded samples"""
+
+    def __init__(self, size=256):
+        self.size = size
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.items:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+class Dataset():
+    """Random access over a split of a dataset directory
+
+    Samples are dicts with the fields of the record: files decoded by decode_field, the
+    other values (label of the basic datasets, rotation) as arrays, and key, the
+    <batch>_<frame> of the frame. Fields decoded by tensors.py are views of its arrays
+
+    Args:
+        path (str): The dataset directory, e.g. ../bdataset
+        split (str): train or test, the records of <split>.json
+        cache_size (int): Decoded samples kept in memory, 0 disables the cache
+        workers (int): Threads decoding the files of a batch, the decoders release the GIL
+        maxvalue (float): depth clipping distance, the tensors keep the one they were written with
+        use_tensors (bool): Read the fields decoded by tensors.py from its arrays
+    """
+
+    def __init__(self, path, split="train", cache_size=256, workers=8, maxvalue=80, use_tensors=True):
+        self.path = path
+        self.maxvalue = maxvalue
+        with open(os.path.join(path, f"{split}.json"), 'r') as f:
+            self.records = json.load(f)
+        self.cache = LRUCache(cache_size)
+        self.pool = ThreadPoolExecutor(max(1, workers))
+        self.tensors, self.rows = self.load_tensors() if use_tensors else ({}, {})
+
+    def load_tensors(self):
+        # field -> memory mapped array and frame key -> row of the arrays
+        try:
+            with open(os.path.join(self.path, TENSOR_INDEX), 'r') as f:
+                index = json.load(f)
+        except OSError:
+            return {}, {}
+        tensors = {name: np.load(os.path.join(self.path, tensor["file"]), mmap_mode='r')
+                   for name, tensor in index["tensors"].items()}
+        # depth_L is the tensor of the depthL field
+        tensors = {name.replace('_', ''): array for name, array in tensors.items()}
+        return tensors, {key: row for row, key in enumerate(index["keys"])}
+
+    def __len__(self):
+        return len(self.records)
+
+    def key(self, index):
+        record = self.records[index]
+        name = next(value for value in record.values() if isinstance(value, str))
+        return name[:11]
+
+    def load(self, index):
+        record = self.records[index]
+        key = self.key(index)
+        row = self.rows.get(key)
+        sample = {"key": key}
+        for field, value in record.items():
+            if row is not None and field in self.tensors:
+                sample[field] = self.tensors[field][row]
+            elif isinstance(value, str):
+                sample[field] = decode_field(field, os.path.join(self.path, value), self.maxvalue)
+            else:
+                sample[field] = np.array(value)
+        # passes only decoded by tensors.py, e.g. albedo and flow
+        if row is not None:
+            for field, tensor in self.tensors.items():
+                sample.setdefault(field, tensor[row])
+        return sample
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"sample {index} out of range")
+        sample = self.cache.get(index)
+        if sample is None:
+            sample = self.load(index)
+            self.cache.put(index, sample)
+        return sample
+
+    def fetch(self, indices):
+        # the samples of a batch, decoded in parallel
+        return list(self.pool.map(self.__getitem__, indices))
+
+    def batches(self, batch_size=32, shuffle=False, seed=None):
+        order = list(range(len(self)))
+        if shuffle:
+            random.Random(seed).shuffle(order)
+        for start in range(0, len(order), batch_size):
+            yield self.fetch(order[start:start + batch_size])
+
+    def close(self):
+        self.pool.shutdown()
+
+
+def benchmark(dataset, samples=1024, batch_size=32, seed=0):
+    # samples per second of random batches, first decoded then again from the cache
+    indices = random.Random(seed).sample(range(len(dataset)), min(samples, len(dataset)))
+    for name in ["decode", "cached"]:
+        ti = time.time()
+        for start in range(0, len(indices), batch_size):
+            dataset.fetch(indices[start:start + batch_size])
+        seconds = time.time() - ti
+        print("{0:8} {1:9.1f} samples/s".format(name, len(indices) / seconds))
+    print(f"cache hits {dataset.cache.hits}, misses {dataset.cache.misses}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="reads a dataset and measures the samples per second")
+    parser.add_argument("dest", type=str, default="bdataset", help="dataset directory in the parent directory")
+    parser.add_argument("--split", type=str, default="train")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=8, help="decoding threads")
+    parser.add_argument("--samples", type=int, default=1024, help="samples read per measure")
+    parser.add_argument("--no-tensors", action="store_true", help="decode the files even when tensors.py arrays exist")
+    opt = parser.parse_args()
+
+    path = os.path.join(os.path.dirname(os.getcwd()), opt.dest)
+    dataset = Dataset(path, opt.split, cache_size=opt.samples, workers=opt.workers, use_tensors=not opt.no_tensors)
+    print(f"{len(dataset)} samples, tensors: {', '.join(dataset.tensors) or 'none'}")
+    benchmark(dataset, opt.samples, opt.batch_size)
+    dataset.close()
@@ -25,7 +25,10 @@ import bpy
 import sys
 import time
 import json
+import shutil
 import pickle
+import struct
+import zlib
 import argparse
 import mathutils
 import numpy as np
@@ -33,6 +36,10 @@ from pathlib import Path
 import bpy_extras.object_utils
 from typing import List, Dict
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import exr  # noqa: E402
+from capture import EncoderPool, get_scratch_path  # noqa: E402
+
 
 # -----------------------------------------------------------------------------
 # STATIC STRINGS (for regex matching)
@@ -1505,6 +1512,50 @@ def get_preferences(context=None):
 
 FRAME_FORMAT = 6
 FNAME_FORMAT = 4
+EXR_PRECISION = {"half": "16", "float": "32"}
+# passes each render type can write, all of them are written by default
+PASSES = {
+    "basic": ["rgb", "depth", "normal", "albedo"],
+    "flow": ["rgb", "depth", "flow", "normal", "albedo"],
+    "stereo": ["rgb", "depth", "normal"],
+}
+# passes derived from the depth and ids of a render instead of rendered, only written when requested
+DERIVED_PASSES = {
+    "basic": ["flow"],
+    "stereo": ["disparity", "consistency"],
+}
+MANIFEST = "manifest.jsonl"
+STAGING = ".staging"
+# depth written for background pixels
+BACKGROUND_DEPTH = 1e10
+# object properties read by the material variants, per variant key, with their identity value
+VARIANT_PROPERTIES = {
+    "tint": ("pmc_tint", (1.0, 1.0, 1.0)),
+    "roughness": ("pmc_roughness", 1.0),
+    "uv_scale": ("pmc_uv_scale", 1.0),
+    "uv_rotation": ("pmc_uv_rot", 0.0),
+}
+# decimation ratio of the objects whose largest size on screen is below a number of pixels
+LOD_TIERS = [[32, 0.1], [64, 0.25], [128, 0.5]]
+# eevee quality settings of the render presets, from fastest to best
+EEVEE_PRESETS = {
+    "draft": {"taa_render_samples": 8, "shadow_cube_size": "512", "shadow_cascade_size": "1024",
+              "use_soft_shadows": False, "use_ssr": False, "use_gtao": False},
+    "standard": {"taa_render_samples": 32, "shadow_cube_size": "1024", "shadow_cascade_size": "2048",
+                 "use_soft_shadows": True, "use_ssr": False, "use_gtao": True},
+    "production": {"taa_render_samples": 128, "shadow_cube_size": "2048", "shadow_cascade_size": "4096",
+                   "use_soft_shadows": True, "use_ssr": True, "use_gtao": True},
+}
+# eevee settings of the startup scene, restored before each batch applies its preset
+EEVEE_DEFAULTS = None
+# cycles samples of the startup scene
+CYCLES_SAMPLES = None
+# cycles sample caps per pass, the auxiliary passes converge after one sample
+CYCLES_PASS_SAMPLES = {"depth": 1, "normal": 1, "albedo": 1, "flow": 1}
+# file names of the rendered frames, <batch>_<frame><label>.<ext>
+SEARCH_FRAME = r"^([0-9]{%d})_([0-9]{%d})[a-z]" % (FNAME_FORMAT, FRAME_FORMAT)
+# re-rendering passes of existing frames, their annotations are kept
+RERENDER = False
 
 
 def blockPrint():
@@ -1531,6 +1582,15 @@ def update_progress(job_title: str, progress):
     sys.stdout.flush()
 
 
+def report_timing(job_title, times, profile):
+    if not times:
+        return
+    msg = "\r{0:40} {1} frames {2:0.3f}s/frame (min {3:0.3f}s, max {4:0.3f}s) {5}\r\n".format(
+        job_title[:40], len(times), sum(times) / len(times), min(times), max(times), profile)
+    sys.stdout.write(msg)
+    sys.stdout.flush()
+
+
 def finish_progress(job_title, time_spent):
     length = 20  # modify this to change the length
     msg = "\r{0:40} [{1}] {2:6.2f}%".format(job_title[:40], "#"*length, 100)
@@ -1548,6 +1608,9 @@ def initialize_blender():
     bpy.types.Object.class_name = bpy.props.StringProperty()
     bpy.types.Object.world_vertices = bpy.props.CollectionProperty(
         type=VectorPropertiesGroup)
+    # the imported file and seed of the mesh, and the full mesh of decimated objects
+    bpy.types.Object.source_key = bpy.props.StringProperty()
+    bpy.types.Object.full_mesh = bpy.props.PointerProperty(type=bpy.types.Mesh)
 
     old = blockPrint()
     override = bpy.context.copy()
@@ -1565,7 +1628,246 @@ def initialize_blender():
     enablePrint(old)
 
 
-def setup_eevee_basic(resolution, id, base_path="out"):
+def apply_output_format(image_format, settings):
+    # per pass output settings from the render config, anything missing keeps blender's default
+    if image_format.file_format in ('OPEN_EXR', 'OPEN_EXR_MULTILAYER'):
+        if "codec" in settings:
+            image_format.exr_codec = settings["codec"].upper()
+        if "precision" in settings:
+            image_format.color_depth = EXR_PRECISION[settings["precision"]]
+    elif image_format.file_format == 'PNG':
+        if "color_depth" in settings:
+            image_format.color_depth = str(settings["color_depth"])
+        if "compression" in settings:
+            image_format.compression = settings["compression"]
+
+
+def create_file_output(tree, label, base_path, id, file_format='OPEN_EXR', formats=None, key=None):
+    # create a file output node writing <id>_<frame><label> in the given format
+    file_output = tree.nodes.new(type="CompositorNodeOutputFile")
+    file_output.label = label
+    file_output.base_path = base_path
+    file_output.format.file_format = file_format
+    apply_output_format(file_output.format, (formats or {}).get(key or label, {}))
+    file_output.file_slots[0].path = (
+        (f"%0{FNAME_FORMAT}d_" % id) + "#" * FRAME_FORMAT) + label
+    return file_output
+
+
+class FileOutputs():
+    """File outputs of a render tree, either a file per pass or a single multilayer EXR
+    per frame holding every pass as a layer named after it"""
+
+    def __init__(self, tree, base_path, id, formats=None, multilayer=False, views_format=None):
+        self.tree = tree
+        self.base_path = base_path
+        self.id = id
+        self.formats = formats or {}
+        self.multilayer = multilayer
+        self.views_format = views_format
+        self.layers = None
+
+    def create_layers(self, label):
+        # the multilayer node writes <id>_<frame>layers.exr, its first slot is the first pass
+        self.layers = self.tree.nodes.new(type="CompositorNodeOutputFile")
+        self.layers.label = 'layers'
+        self.layers.format.file_format = 'OPEN_EXR_MULTILAYER'
+        apply_output_format(self.layers.format, self.formats.get('layers', {}))
+        if self.views_format:
+            self.layers.format.views_format = self.views_format
+        self.layers.base_path = os.path.join(self.base_path, (
+            (f"%0{FNAME_FORMAT}d_" % self.id) + "#" * FRAME_FORMAT) + self.layers.label)
+        self.layers.layer_slots[0].name = label
+
+    def add(self, label, socket, file_format='OPEN_EXR', key=None):
+        # write the socket as the pass named label
+        if not self.multilayer:
+            file_output = create_file_output(
+                self.tree, label, self.base_path, self.id, file_format, self.formats, key)
+            if self.views_format:
+                file_output.format.views_format = self.views_format
+            self.tree.links.new(socket, file_output.inputs[0])
+            return
+        if self.layers is None:
+            self.create_layers(label)
+        else:
+            self.layers.layer_slots.new(label)
+        self.tree.links.new(socket, self.layers.inputs[label])
+
+
+def setup_normal_bias(tree, render_layers):
+    # map normals from [-1, 1] to [0, 1]
+    links = tree.links
+    scale_normal = tree.nodes.new(type="CompositorNodeMixRGB")
+    scale_normal.blend_type = 'MULTIPLY'
+    scale_normal.inputs[2].default_value = (0.5, 0.5, 0.5, 1)
+    links.new(render_layers.outputs['Normal'], scale_normal.inputs[1])
+
+    bias_normal = tree.nodes.new(type="CompositorNodeMixRGB")
+    bias_normal.blend_type = 'ADD'
+    bias_normal.inputs[2].default_value = (0.5, 0.5, 0.5, 0)
+    links.new(scale_normal.outputs[0], bias_normal.inputs[1])
+    return bias_normal
+
+
+def setup_view_layer(passes, instances=False, analytic_flow=False):
+    # only enable the passes that are written, the others are never computed. the analytic
+    # flow is computed from the depth and object ids instead of the vector pass
+    view_layer = bpy.context.scene.view_layers["View Layer"]
+    view_layer.use_pass_z = "depth" in passes or "disparity" in passes or analytic_flow
+    view_layer.use_pass_normal = "normal" in passes
+    view_layer.use_pass_diffuse_color = "albedo" in passes
+    view_layer.use_pass_vector = "flow" in passes and not analytic_flow
+    view_layer.use_pass_cryptomatte_object = instances or analytic_flow
+
+
+def setup_border_fill(tree, render_layers):
+    # pixels outside the render border are left transparent, fill them with the background
+    # the rest of the frame would have. returns the filled image and depth sockets
+    links = tree.links
+    world = bpy.context.scene.world
+    color, strength = (0, 0, 0), 1
+    if world is not None:
+        color = world.color
+        background = world.node_tree.nodes.get("Background") if world.use_nodes else None
+        if background is not None:
+            color = background.inputs['Color'].default_value[:3]
+            strength = background.inputs['Strength'].default_value
+
+    background_color = tree.nodes.new(type="CompositorNodeRGB")
+    background_color.outputs[0].default_value = (*[c * strength for c in color], 1)
+    fill_image = tree.nodes.new(type="CompositorNodeAlphaOver")
+    links.new(background_color.outputs[0], fill_image.inputs[1])
+    links.new(render_layers.outputs['Image'], fill_image.inputs[2])
+
+    # depth * alpha + BACKGROUND_DEPTH * (1 - alpha) with math nodes, so depth stays a value
+    # socket and is written as a single channel
+    object_depth = tree.nodes.new(type="CompositorNodeMath")
+    object_depth.operation = 'MULTIPLY'
+    links.new(render_layers.outputs['Depth'], object_depth.inputs[0])
+    links.new(render_layers.outputs['Alpha'], object_depth.inputs[1])
+    coverage = tree.nodes.new(type="CompositorNodeMath")
+    coverage.operation = 'SUBTRACT'
+    coverage.inputs[0].default_value = 1
+    links.new(render_layers.outputs['Alpha'], coverage.inputs[1])
+    background_depth = tree.nodes.new(type="CompositorNodeMath")
+    background_depth.operation = 'MULTIPLY'
+    background_depth.inputs[1].default_value = BACKGROUND_DEPTH
+    links.new(coverage.outputs[0], background_depth.inputs[0])
+    fill_depth = tree.nodes.new(type="CompositorNodeMath")
+    fill_depth.operation = 'ADD'
+    links.new(object_depth.outputs[0], fill_depth.inputs[0])
+    links.new(background_depth.outputs[0], fill_depth.inputs[1])
+    return fill_image.outputs[0], fill_depth.outputs[0]
+
+
+def setup_instance_pass(tree, render_layers, depth=None):
+    # send the object cryptomatte layer to the viewer so the ids of each pixel can be read
+    # back after the render without going through a file. with a depth socket, it replaces
+    # the blue channel (the rank 1 ids) for the analytic flow
+    viewer = tree.nodes.new(type="CompositorNodeViewer")
+    viewer.use_alpha = True
+    crypto = render_layers.outputs['CryptoObject00']
+    if depth is not None:
+        separate = tree.nodes.new(type="CompositorNodeSepRGBA")
+        combine = tree.nodes.new(type="CompositorNodeCombRGBA")
+        tree.links.new(crypto, separate.inputs[0])
+        tree.links.new(separate.outputs['R'], combine.inputs['R'])
+        tree.links.new(separate.outputs['G'], combine.inputs['G'])
+        tree.links.new(depth, combine.inputs['B'])
+        tree.links.new(separate.outputs['A'], combine.inputs['A'])
+        crypto = combine.outputs[0]
+    tree.links.new(crypto, viewer.inputs['Image'])
+    tree.nodes.active = viewer
+
+
+def get_focal_pixels(scene, camera):
+    # focal length of the camera in pixels along the axis the sensor is fitted to
+    sensor_fit = camera.data.sensor_fit
+    if sensor_fit == 'AUTO':
+        sensor, pixels = camera.data.sensor_width, max(scene.render.resolution_x, scene.render.resolution_y)
+    elif sensor_fit == 'HORIZONTAL':
+        sensor, pixels = camera.data.sensor_width, scene.render.resolution_x
+    else:
+        sensor, pixels = camera.data.sensor_height, scene.render.resolution_y
+    return camera.data.lens / sensor * pixels * scene.render.resolution_percentage / 100
+
+
+def setup_disparity(tree, depth):
+    # disparity in pixels between the views, focal length * interocular distance / depth.
+    # off axis and toe in cameras converge at the convergence distance, where it is zero
+    scene = bpy.context.scene
+    stereo = scene.camera.data.stereo
+    scale = get_focal_pixels(scene, scene.camera) * stereo.interocular_distance
+    divide = tree.nodes.new(type="CompositorNodeMath")
+    divide.operation = 'DIVIDE'
+    divide.inputs[0].default_value = scale
+    tree.links.new(depth, divide.inputs[1])
+    if stereo.convergence_mode == 'PARALLEL':
+        return divide.outputs[0]
+    subtract = tree.nodes.new(type="CompositorNodeMath")
+    subtract.operation = 'SUBTRACT'
+    tree.links.new(divide.outputs[0], subtract.inputs[0])
+    subtract.inputs[1].default_value = scale / stereo.convergence_distance
+    return subtract.outputs[0]
+
+
+def setup_eevee_preset(passes, preset=None):
+    # set the eevee quality settings of a preset, returns a description of the profile. without
+    # a preset the settings of the startup file are used. the scenes of the batches are copies
+    # of the previous one, the settings a batch changed are reset first
+    global EEVEE_DEFAULTS
+    eevee = bpy.context.scene.eevee
+    if EEVEE_DEFAULTS is None:
+        names = {name for settings in EEVEE_PRESETS.values() for name in settings}
+        EEVEE_DEFAULTS = {name: getattr(eevee, name) for name in names}
+    for name, value in EEVEE_DEFAULTS.items():
+        setattr(eevee, name, value)
+    if preset is not None:
+        if preset not in EEVEE_PRESETS:
+            raise ValueError(f"unknown preset {preset}, use one of {', '.join(EEVEE_PRESETS)}")
+        for name, value in EEVEE_PRESETS[preset].items():
+            setattr(eevee, name, value)
+    # without the image only one sample is needed for the data passes
+    if "rgb" not in passes:
+        eevee.taa_render_samples = 1
+    return "eevee preset={} samples={} shadows={}/{}{} ssr={} ao={}".format(
+        preset or "default", eevee.taa_render_samples, eevee.shadow_cube_size, eevee.shadow_cascade_size,
+        " soft" if eevee.use_soft_shadows else "", "on" if eevee.use_ssr else "off",
+        "on" if eevee.use_gtao else "off")
+
+
+def setup_cycles_sampling(settings, passes):
+    # sampling budget of the flow renders, returns a description of the profile
+    scene = bpy.context.scene
+    scene.render.use_persistent_data = settings.get("persistent_data", False)
+    scene.cycles.use_adaptive_sampling = "adaptive_threshold" in settings
+    if "adaptive_threshold" in settings:
+        scene.cycles.adaptive_threshold = settings["adaptive_threshold"]
+    if "threads" in settings:
+        scene.render.threads_mode = 'FIXED'
+        scene.render.threads = settings["threads"]
+    else:
+        scene.render.threads_mode = 'AUTO'
+
+    # render as many samples as the most demanding pass that is written. the count of the
+    # startup scene is the default, the scene of a batch has the capped count of the previous
+    global CYCLES_SAMPLES
+    if CYCLES_SAMPLES is None:
+        CYCLES_SAMPLES = scene.cycles.samples
+    samples = settings.get("samples", CYCLES_SAMPLES)
+    caps = dict(CYCLES_PASS_SAMPLES, **settings.get("pass_samples", {}))
+    scene.cycles.samples = max([min(samples, caps.get(p, samples)) for p in passes] or [1])
+
+    return "cycles samples={} adaptive={} persistent={} threads={}".format(
+        scene.cycles.samples,
+        scene.cycles.adaptive_threshold if scene.cycles.use_adaptive_sampling else "off",
+        "on" if scene.render.use_persistent_data else "off",
+        scene.render.threads if scene.render.threads_mode == 'FIXED' else "auto")
+
+
+def setup_eevee_basic(resolution, id, base_path="out", instances=False, formats=None, multilayer=False, passes=None,
+                      border=False, preset=None):
     scene = bpy.context.scene
     scene.render.engine = 'BLENDER_EEVEE'
     scene.render.resolution_x = resolution
@@ -1578,66 +1880,49 @@ def setup_eevee_basic(resolution, id, base_path="out"):
     scene.render.use_high_quality_normals = True
 
     scene.use_nodes = True
-    scene.view_layers["View Layer"].use_pass_normal = True
-    scene.view_layers["View Layer"].use_pass_diffuse_color = True
+    passes = PASSES["basic"] if passes is None else passes
+    setup_view_layer(passes, instances, analytic_flow="flow" in passes)
+    profile = setup_eevee_preset(passes, preset)
 
     tree = scene.node_tree
-    links = tree.links
     for n in tree.nodes:
         tree.nodes.remove(n)
 
     # Create input render layer node.
     render_layers = tree.nodes.new('CompositorNodeRLayers')
+    outputs = FileOutputs(tree, base_path, id, formats, multilayer)
+    image, depth = render_layers.outputs['Image'], render_layers.outputs['Depth']
+    if border and not scene.render.film_transparent:
+        image, depth = setup_border_fill(tree, render_layers)
 
     # Depth setup
-    depth_file_output = tree.nodes.new(type="CompositorNodeOutputFile")
-    depth_file_output.label = 'depth'
-    depth_file_output.base_path = base_path
-    depth_file_output.format.file_format = 'OPEN_EXR'
-    links.new(render_layers.outputs['Depth'],
-              depth_file_output.inputs['Image'])
-    depth_file_output.file_slots[0].path = (
-        (f"%0{FNAME_FORMAT}d_" % id) + "#" * FRAME_FORMAT) + depth_file_output.label
+    if "depth" in passes:
+        outputs.add('depth', depth)
 
     # Normal setup
-    scale_normal = tree.nodes.new(type="CompositorNodeMixRGB")
-    scale_normal.blend_type = 'MULTIPLY'
-    scale_normal.inputs[2].default_value = (0.5, 0.5, 0.5, 1)
-    links.new(render_layers.outputs['Normal'], scale_normal.inputs[1])
-
-    bias_normal = tree.nodes.new(type="CompositorNodeMixRGB")
-    bias_normal.blend_type = 'ADD'
-    bias_normal.inputs[2].default_value = (0.5, 0.5, 0.5, 0)
-    links.new(scale_normal.outputs[0], bias_normal.inputs[1])
-
-    normal_file_output = tree.nodes.new(type="CompositorNodeOutputFile")
-    normal_file_output.label = 'normal'
-    normal_file_output.base_path = base_path
-    normal_file_output.format.file_format = 'OPEN_EXR'
-    links.new(bias_normal.outputs[0], normal_file_output.inputs[0])
-    normal_file_output.file_slots[0].path = (
-        (f"%0{FNAME_FORMAT}d_" % id) + "#" * FRAME_FORMAT) + normal_file_output.label
+    if "normal" in passes:
+        bias_normal = setup_normal_bias(tree, render_layers)
+        outputs.add('normal', bias_normal.outputs[0])
 
     # Albedo setup
-    albedo_file_output = tree.nodes.new(type="CompositorNodeOutputFile")
-    albedo_file_output.label = 'albedo'
-    albedo_file_output.base_path = base_path
-    albedo_file_output.format.file_format = 'OPEN_EXR'
-    links.new(render_layers.outputs['DiffCol'], albedo_file_output.inputs[0])
-    albedo_file_output.file_slots[0].path = (
-        (f"%0{FNAME_FORMAT}d_" % id) + "#" * FRAME_FORMAT) + albedo_file_output.label
+    if "albedo" in passes:
+        outputs.add('albedo', render_layers.outputs['DiffCol'])
 
     # Render setup
-    render_file_output = tree.nodes.new(type="CompositorNodeOutputFile")
-    render_file_output.label = 'rgb'
-    render_file_output.base_path = base_path
-    render_file_output.format.file_format = 'PNG'
-    links.new(render_layers.outputs['Image'], render_file_output.inputs[0])
-    render_file_output.file_slots[0].path = (
-        (f"%0{FNAME_FORMAT}d_" % id) + "#" * FRAME_FORMAT) + render_file_output.label
+    if "rgb" in passes:
+        outputs.add('rgb', image, 'PNG')
+
+    # Instance and analytic flow setup, the flow is written after each render
+    if "flow" in passes:
+        setup_instance_pass(tree, render_layers, render_layers.outputs['Depth'])
+    elif instances:
+        setup_instance_pass(tree, render_layers)
 
+    return profile
 
-def setup_cycles_flow(resolution, id, base_path="out"):
+
+def setup_cycles_flow(resolution, id, base_path="out", instances=False, formats=None, multilayer=False, passes=None,
+                      cycles=None, border=False):
     scene = bpy.context.scene
     scene.render.engine = 'CYCLES'
     # scene.cycles.device = 'GPU'
@@ -1648,77 +1933,50 @@ def setup_cycles_flow(resolution, id, base_path="out"):
     scene.render.image_settings.color_depth = "16"
 
     scene.use_nodes = True
-    scene.view_layers["View Layer"].use_pass_vector = True
-    scene.view_layers["View Layer"].use_pass_normal = True
-    scene.view_layers["View Layer"].use_pass_diffuse_color = True
+    passes = PASSES["flow"] if passes is None else passes
+    setup_view_layer(passes, instances)
+    profile = setup_cycles_sampling(cycles or {}, passes)
 
     tree = scene.node_tree
-    links = tree.links
     for n in tree.nodes:
         tree.nodes.remove(n)
 
     # Create input render layer node.
     render_layers = tree.nodes.new('CompositorNodeRLayers')
+    outputs = FileOutputs(tree, base_path, id, formats, multilayer)
+    image, depth = render_layers.outputs['Image'], render_layers.outputs['Depth']
+    if border and not scene.render.film_transparent:
+        image, depth = setup_border_fill(tree, render_layers)
 
     # Depth setup
-    depth_file_output = tree.nodes.new(type="CompositorNodeOutputFile")
-    depth_file_output.label = 'depth'
-    depth_file_output.base_path = base_path
-    depth_file_output.format.file_format = 'OPEN_EXR'
-    links.new(render_layers.outputs['Depth'],
-              depth_file_output.inputs['Image'])
-    depth_file_output.file_slots[0].path = (
-        (f"%0{FNAME_FORMAT}d_" % id) + "#" * FRAME_FORMAT) + depth_file_output.label
+    if "depth" in passes:
+        outputs.add('depth', depth)
 
     # Optical Flow setup
-    flow_file_output = tree.nodes.new(type="CompositorNodeOutputFile")
-    flow_file_output.label = 'flow'
-    flow_file_output.base_path = base_path
-    flow_file_output.format.file_format = 'OPEN_EXR'
-    links.new(render_layers.outputs['Vector'],
-              flow_file_output.inputs['Image'])
-    flow_file_output.file_slots[0].path = (
-        (f"%0{FNAME_FORMAT}d_" % id) + "#" * FRAME_FORMAT) + flow_file_output.label
+    if "flow" in passes:
+        outputs.add('flow', render_layers.outputs['Vector'])
 
     # Normal setup
-    scale_normal = tree.nodes.new(type="CompositorNodeMixRGB")
-    scale_normal.blend_type = 'MULTIPLY'
-    scale_normal.inputs[2].default_value = (0.5, 0.5, 0.5, 1)
-    links.new(render_layers.outputs['Normal'], scale_normal.inputs[1])
-
-    bias_normal = tree.nodes.new(type="CompositorNodeMixRGB")
-    bias_normal.blend_type = 'ADD'
-    bias_normal.inputs[2].default_value = (0.5, 0.5, 0.5, 0)
-    links.new(scale_normal.outputs[0], bias_normal.inputs[1])
-
-    normal_file_output = tree.nodes.new(type="CompositorNodeOutputFile")
-    normal_file_output.label = 'normal'
-    normal_file_output.base_path = base_path
-    normal_file_output.format.file_format = 'OPEN_EXR'
-    links.new(bias_normal.outputs[0], normal_file_output.inputs[0])
-    normal_file_output.file_slots[0].path = (
-        (f"%0{FNAME_FORMAT}d_" % id) + "#" * FRAME_FORMAT) + normal_file_output.label
+    if "normal" in passes:
+        bias_normal = setup_normal_bias(tree, render_layers)
+        outputs.add('normal', bias_normal.outputs[0])
 
     # Albedo setup
-    albedo_file_output = tree.nodes.new(type="CompositorNodeOutputFile")
-    albedo_file_output.label = 'albedo'
-    albedo_file_output.base_path = base_path
-    albedo_file_output.format.file_format = 'OPEN_EXR'
-    links.new(render_layers.outputs['DiffCol'], albedo_file_output.inputs[0])
-    albedo_file_output.file_slots[0].path = (
-        (f"%0{FNAME_FORMAT}d_" % id) + "#" * FRAME_FORMAT) + albedo_file_output.label
+    if "albedo" in passes:
+        outputs.add('albedo', render_layers.outputs['DiffCol'])
 
     # Render setup
-    render_file_output = tree.nodes.new(type="CompositorNodeOutputFile")
-    render_file_output.label = 'rgb'
-    render_file_output.base_path = base_path
-    render_file_output.format.file_format = 'PNG'
-    links.new(render_layers.outputs['Image'], render_file_output.inputs[0])
-    render_file_output.file_slots[0].path = (
-        (f"%0{FNAME_FORMAT}d_" % id) + "#" * FRAME_FORMAT) + render_file_output.label
+    if "rgb" in passes:
+        outputs.add('rgb', image, 'PNG')
+
+    # Instance setup
+    if instances:
+        setup_instance_pass(tree, render_layers)
+
+    return profile
 
 
-def setup_eevee_stereo(resolution, id, base_path="out"):
+def setup_eevee_stereo(resolution, id, base_path="out", formats=None, multilayer=False, passes=None, preset=None):
     scene = bpy.context.scene
     scene.render.engine = 'BLENDER_EEVEE'
     scene.render.resolution_x = resolution
@@ -1734,56 +1992,36 @@ def setup_eevee_stereo(resolution, id, base_path="out"):
     scene.render.use_multiview = True
 
     scene.use_nodes = True
-    scene.view_layers["View Layer"].use_pass_normal = True
+    passes = PASSES["stereo"] if passes is None else passes
+    setup_view_layer(passes)
+    profile = setup_eevee_preset(passes, preset) + " stereo"
 
     tree = scene.node_tree
-    links = tree.links
     for n in tree.nodes:
         tree.nodes.remove(n)
 
     # Create input render layer node.
     render_layers = tree.nodes.new('CompositorNodeRLayers')
+    outputs = FileOutputs(tree, base_path, id, formats, multilayer, views_format='INDIVIDUAL')
 
     # Stereo setup
-    stereo_file_output = tree.nodes.new(type="CompositorNodeOutputFile")
-    stereo_file_output.label = 'stereo'
-    stereo_file_output.base_path = base_path
-    stereo_file_output.format.file_format = 'PNG'
-    stereo_file_output.format.views_format = 'INDIVIDUAL'
-    links.new(render_layers.outputs['Image'], stereo_file_output.inputs[0])
-    stereo_file_output.file_slots[0].path = (
-        (f"%0{FNAME_FORMAT}d_" % id) + "#" * FRAME_FORMAT) + stereo_file_output.label
+    if "rgb" in passes:
+        outputs.add('stereo', render_layers.outputs['Image'], 'PNG', key='rgb')
 
     # Depth setup
-    depth_file_output = tree.nodes.new(type="CompositorNodeOutputFile")
-    depth_file_output.label = 'depth'
-    depth_file_output.base_path = base_path
-    depth_file_output.format.file_format = 'OPEN_EXR'
-    depth_file_output.format.views_format = 'INDIVIDUAL'
-    links.new(render_layers.outputs['Depth'],
-              depth_file_output.inputs['Image'])
-    depth_file_output.file_slots[0].path = (
-        (f"%0{FNAME_FORMAT}d_" % id) + "#" * FRAME_FORMAT) + depth_file_output.label
+    if "depth" in passes:
+        outputs.add('depth', render_layers.outputs['Depth'])
 
     # Normal setup
-    scale_normal = tree.nodes.new(type="CompositorNodeMixRGB")
-    scale_normal.blend_type = 'MULTIPLY'
-    scale_normal.inputs[2].default_value = (0.5, 0.5, 0.5, 1)
-    links.new(render_layers.outputs['Normal'], scale_normal.inputs[1])
+    if "normal" in passes:
+        bias_normal = setup_normal_bias(tree, render_layers)
+        outputs.add('normal', bias_normal.outputs[0])
 
-    bias_normal = tree.nodes.new(type="CompositorNodeMixRGB")
-    bias_normal.blend_type = 'ADD'
-    bias_normal.inputs[2].default_value = (0.5, 0.5, 0.5, 0)
-    links.new(scale_normal.outputs[0], bias_normal.inputs[1])
+    # Disparity setup, the consistency masks are computed from it after each render
+    if "disparity" in passes:
+        outputs.add('disparity', setup_disparity(tree, render_layers.outputs['Depth']))
 
-    normal_file_output = tree.nodes.new(type="CompositorNodeOutputFile")
-    normal_file_output.label = 'normal'
-    normal_file_output.base_path = base_path
-    normal_file_output.format.file_format = 'OPEN_EXR'
-    normal_file_output.format.views_format = 'INDIVIDUAL'
-    links.new(bias_normal.outputs[0], normal_file_output.inputs[0])
-    normal_file_output.file_slots[0].path = (
-        (f"%0{FNAME_FORMAT}d_" % id) + "#" * FRAME_FORMAT) + normal_file_output.label
+    return profile
 
 
 def randomize_vertices(obj, seed):
@@ -1805,6 +2043,7 @@ def setup_object(bpy_obj, obj):
     bpy_obj.rotation_euler = np.deg2rad(obj.get("rotation", [0, 0, 0]))
     bpy_obj.scale = obj.get("scale", [1, 1, 1])
     bpy_obj.class_name = obj.get("class", "undefined")
+    bpy_obj.source_key = f'{os.path.abspath(obj["path"])}:{obj.get("seed", 0)}'
     if obj.get("seed", 0) and isinstance(obj.data, bpy.types.Mesh):
         randomize_vertices(bpy_obj, obj.get("seed", 0))
 
@@ -1846,13 +2085,83 @@ def import_material(mat: Dict):
     return material
 
 
-def setup_object_data(obj, mats):
-    # get world vertices for the object
+def set_world_vertices(obj):
+    # store the world vertices of the object mesh on the object
     R = mathutils.Euler(obj.rotation_euler).to_matrix().to_4x4()
     T = mathutils.Matrix.Translation(obj.location)
     S = mathutils.Matrix.Diagonal(obj.scale).to_4x4()
-    for v in [T @ R @ S @ v.co for v in obj.data.vertices]:
-        obj.world_vertices.add().v = v
+    matrix = np.array(T @ R @ S)
+    co = np.empty(len(obj.data.vertices) * 3, dtype=np.float32)
+    obj.data.vertices.foreach_get("co", co)
+    co = co.reshape(-1, 3) @ matrix[:3, :3].T + matrix[:3, 3]
+    obj.world_vertices.clear()
+    for _ in range(len(co)):
+        obj.world_vertices.add()
+    obj.world_vertices.foreach_set("v", co.astype(np.float32).ravel())
+
+
+def set_variant(obj, variant):
+    # store the variant of an object in the properties its materials read, identity by default
+    for key in variant:
+        if key not in VARIANT_PROPERTIES:
+            raise ValueError(f"unknown variant parameter {key}, use {', '.join(VARIANT_PROPERTIES)}")
+    for key, (name, identity) in VARIANT_PROPERTIES.items():
+        obj[name] = variant.get(key, identity)
+
+
+def insert_node(tree, socket, node, index=0):
+    # route what goes into socket through the input index of node
+    if socket.is_linked:
+        tree.links.new(socket.links[0].from_socket, node.inputs[index])
+    else:
+        node.inputs[index].default_value = socket.default_value
+    tree.links.new(node.outputs[0], socket)
+
+
+def add_object_attribute(tree, name, socket, node, index=1):
+    # feed the object property name into the input index of node
+    attribute = tree.nodes.new(type='ShaderNodeAttribute')
+    attribute.attribute_type = 'OBJECT'
+    attribute.attribute_name = name
+    tree.links.new(attribute.outputs[socket], node.inputs[index])
+
+
+def setup_material_variants(material):
+    # make a material read the tint, roughness scale and uv scale/rotation from the
+    # properties of each object using it, so every variant shares the same material
+    tree = material.node_tree
+    if tree is None or "pmc_variant" in tree.nodes:
+        return
+    principled = next((node for node in tree.nodes if node.type == 'BSDF_PRINCIPLED'), None)
+    if principled is None:
+        return
+
+    tint = tree.nodes.new(type='ShaderNodeMixRGB')
+    tint.name = "pmc_variant"
+    tint.blend_type = 'MULTIPLY'
+    tint.inputs['Fac'].default_value = 1
+    insert_node(tree, principled.inputs['Base Color'], tint, 1)
+    add_object_attribute(tree, VARIANT_PROPERTIES["tint"][0], 'Color', tint, 2)
+
+    roughness = tree.nodes.new(type='ShaderNodeMath')
+    roughness.operation = 'MULTIPLY'
+    roughness.use_clamp = True
+    insert_node(tree, principled.inputs['Roughness'], roughness)
+    add_object_attribute(tree, VARIANT_PROPERTIES["roughness"][0], 'Fac', roughness)
+
+    mapping = tree.nodes.get("UberMapping")
+    if mapping is None:
+        return
+    for key, input_name, operation in (("uv_scale", 'Scale', 'MULTIPLY'), ("uv_rotation", 'Global Rotation', 'ADD')):
+        math = tree.nodes.new(type='ShaderNodeMath')
+        math.operation = operation
+        insert_node(tree, mapping.inputs[input_name], math)
+        add_object_attribute(tree, VARIANT_PROPERTIES[key][0], 'Fac', math)
+
+
+def setup_object_data(obj, mats):
+    # get world vertices for the object
+    set_world_vertices(obj)
 
     # assign materials to object
     # delete the old material data
@@ -1919,6 +2228,106 @@ def load_render_frames(frames):
     return range(*frames)
 
 
+def get_world_vertices(obj):
+    # the world vertices stored on the object as an (n, 3) array
+    vertices = np.empty(len(obj.world_vertices) * 3, dtype=np.float32)
+    obj.world_vertices.foreach_get("v", vertices)
+    return vertices.reshape(-1, 3)
+
+
+def project_vertices(scene, camera, vertices):
+    # vectorized bpy_extras.object_utils.world_to_camera_view for an (n, 3) array
+    matrix = np.array(camera.matrix_world.normalized().inverted())
+    co_local = vertices @ matrix[:3, :3].T + matrix[:3, 3]
+    z = -co_local[:, 2]
+
+    frame = camera.data.view_frame(scene=scene)[:3]
+    min_x, max_x = frame[2].x, frame[1].x
+    min_y, max_y = frame[1].y, frame[0].y
+    if camera.data.type != 'ORTHO':
+        # scale the frame to the depth of each vertex
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = -z / frame[0].z
+            x = (co_local[:, 0] - min_x * scale) / ((max_x - min_x) * scale)
+            y = (co_local[:, 1] - min_y * scale) / ((max_y - min_y) * scale)
+        x[z == 0] = 0.5
+        y[z == 0] = 0.5
+    else:
+        x = (co_local[:, 0] - min_x) / (max_x - min_x)
+        y = (co_local[:, 1] - min_y) / (max_y - min_y)
+    return np.stack((x, y, z), axis=-1)
+
+
+def unproject_pixels(scene, camera, depth):
+    # world position of every pixel of a (height, width) depth map, top row first, the
+    # inverse of project_vertices. returns a (height * width, 3) array
+    height, width = depth.shape
+    frame = camera.data.view_frame(scene=scene)[:3]
+    min_x, max_x = frame[2].x, frame[1].x
+    min_y, max_y = frame[1].y, frame[0].y
+    x = min_x + (np.arange(width) + 0.5) / width * (max_x - min_x)
+    y = max_y - (np.arange(height) + 0.5) / height * (max_y - min_y)
+    x, y = np.meshgrid(x, y)
+    if camera.data.type != 'ORTHO':
+        # the frame is at depth -frame.z, scale it to the depth of each pixel
+        scale = depth / -frame[0].z
+        x, y = x * scale, y * scale
+    co_local = np.stack((x, y, -depth), axis=-1).reshape(-1, 3)
+    matrix = np.array(camera.matrix_world.normalized())
+    return co_local @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+def get_projected_sizes(objects, data):
+    # the largest size in pixels each object takes on screen over the views or frames of a
+    # render config, measured on the bounds of its world vertices
+    scene = bpy.context.scene
+    camera = scene.camera
+    resolution = data.get("resolution", 256)
+    if "views" in data:
+        views_x, views_y, views_z = load_render_views(data["views"])
+        rotations = [(x, y, z) for x in views_x for y in views_y for z in views_z]
+        states = [view_state(camera.parent, rotations, frame) for frame in range(len(rotations))]
+    else:
+        states = [frame_state(frame) for frame in get_render_frames(data)]
+
+    sizes = {obj.name: 0 for obj in objects}
+    for set_state in states:
+        set_state(0)
+        bpy.context.view_layer.update()
+        for obj in objects:
+            if not len(obj.world_vertices):
+                continue
+            co = project_vertices(scene, camera, get_world_vertices(obj))
+            co = co[co[:, 2] > 0, :2].clip(0, 1)
+            if len(co):
+                sizes[obj.name] = max(sizes[obj.name], float((co.max(axis=0) - co.min(axis=0)).max()) * resolution)
+    return sizes
+
+
+def get_render_border(objects, margin):
+    # bounds of every object projected on screen plus a margin, the full frame when
+    # something is behind the camera
+    scene = bpy.context.scene
+    vertices = [get_world_vertices(obj) for obj in objects if len(obj.world_vertices)]
+    if not vertices:
+        return 0, 0, 1, 1
+    camera_vertices = project_vertices(scene, scene.camera, np.concatenate(vertices))
+    if np.any(camera_vertices[:, 2] <= 0):
+        return 0, 0, 1, 1
+    min_x, min_y = camera_vertices[:, :2].min(axis=0) - margin
+    max_x, max_y = camera_vertices[:, :2].max(axis=0) + margin
+    return tuple(float(min(max(0, a), 1)) for a in (min_x, min_y, max_x, max_y))
+
+
+def set_render_border(objects, margin):
+    # render only the region of the frame covered by the objects, keeping the image size
+    render_settings = bpy.context.scene.render
+    render_settings.use_border = True
+    render_settings.use_crop_to_border = False
+    (render_settings.border_min_x, render_settings.border_min_y,
+     render_settings.border_max_x, render_settings.border_max_y) = get_render_border(objects, margin)
+
+
 def xyxy2xywh(box):
     min_x, min_y, max_x, max_y = box
     min_x = min(max(0, min_x), 1)
@@ -1949,6 +2358,205 @@ def get_bbox(camera_vertices):
     return xyxy2xywh((minX, minY, maxX, maxY))
 
 
+def murmurhash3_32(data: bytes, seed=0):
+    # MurmurHash3 x86 32 bit, used by cryptomatte to hash object names
+    c1, c2 = 0xcc9e2d51, 0x1b873593
+    h = seed
+    nblocks = len(data) // 4
+    for i in range(nblocks):
+        k = int.from_bytes(data[4 * i:4 * i + 4], 'little')
+        k = (k * c1) & 0xffffffff
+        k = ((k << 15) | (k >> 17)) & 0xffffffff
+        k = (k * c2) & 0xffffffff
+        h ^= k
+        h = ((h << 13) | (h >> 19)) & 0xffffffff
+        h = (h * 5 + 0xe6546b64) & 0xffffffff
+
+    tail = data[nblocks * 4:]
+    k = 0
+    for i in reversed(range(len(tail))):
+        k ^= tail[i] << (8 * i)
+    if tail:
+        k = (k * c1) & 0xffffffff
+        k = ((k << 15) | (k >> 17)) & 0xffffffff
+        k = (k * c2) & 0xffffffff
+        h ^= k
+
+    h ^= len(data)
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & 0xffffffff
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & 0xffffffff
+    h ^= h >> 16
+    return h
+
+
+def cryptomatte_hash(name):
+    # the float id written by cryptomatte for a name. exponents of 0 and 255 are
+    # avoided so the id is never a denormal, inf or nan
+    h = murmurhash3_32(name.encode('utf-8'))
+    exponent = (h >> 23) & 255
+    if exponent == 0 or exponent == 255:
+        h ^= 1 << 23
+    return struct.unpack('<f', struct.pack('<I', h))[0]
+
+
+def read_viewer_pixels():
+    # read the viewer node image as a (height, width, 4) array, top row first
+    image = bpy.data.images['Viewer Node']
+    width, height = image.size
+    pixels = np.empty(width * height * 4, dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    return pixels.reshape(height, width, 4)[::-1]
+
+
+def mask2rle(mask):
+    # uncompressed COCO style run length encoding, column major, starting with a run of zeros
+    flat = mask.ravel(order='F')
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [flat.size])))
+    if flat.size and flat[0]:
+        counts = np.concatenate(([0], counts))
+    return {"size": list(mask.shape), "counts": counts.tolist()}
+
+
+def mask2bbox(mask):
+    # tight box of the visible pixels in the same normalized x, y, w, h format as get_bbox
+    height, width = mask.shape
+    ys = np.flatnonzero(mask.any(axis=1))
+    xs = np.flatnonzero(mask.any(axis=0))
+    min_x, max_x = xs[0], xs[-1] + 1
+    min_y, max_y = ys[0], ys[-1] + 1
+    return ((min_x + max_x) / 2.0 / width, (min_y + max_y) / 2.0 / height,
+            (max_x - min_x) / width, (max_y - min_y) / height)
+
+
+def get_instances(objects, classes):
+    # match the rank 0 cryptomatte id of every pixel against the object name hashes
+    crypto = read_viewer_pixels()
+    ids = crypto[..., 0]
+    annotated = [obj for obj in objects if obj.class_name in classes]
+    if not annotated:
+        return []
+
+    hashes = np.array([cryptomatte_hash(obj.name) for obj in annotated], dtype=np.float32)
+    order = np.argsort(hashes)
+    position = np.searchsorted(hashes[order], ids).clip(0, len(hashes) - 1)
+    index = np.where(hashes[order][position] == ids, order[position] + 1, 0)
+
+    instances = []
+    for i, obj in enumerate(annotated, 1):
+        mask = index == i
+        area = int(np.count_nonzero(mask))
+        if area == 0:
+            continue
+        instances.append({
+            "class": classes.index(obj.class_name),
+            "name": obj.name,
+            "bbox": [float(a) for a in mask2bbox(mask)],
+            "area": area,
+            "mask": mask2rle(mask),
+        })
+    return instances
+
+
+def get_flow(objects, set_state):
+    """Optical flow of the objects from the depth and cryptomatte ids of the last render
+
+    Every pixel is moved with the object it shows to the previous and next state of the
+    scene and projected with the camera of that state. Only rigid motion is followed
+
+    Args:
+        objects (list): The objects moving in the scene
+        set_state (function): sets the scene to the previous (-1), next (1) or current (0) state
+
+    Returns:
+        ndarray: (height, width, 4) flow in pixels, top row first, laid out as the cycles vector
+        pass: previous minus current position, then current minus next position, y up.
+        Zero on the background
+    """
+    scene = bpy.context.scene
+    camera = scene.camera
+    probe = read_viewer_pixels()
+    ids, depth = probe[..., 0].ravel(), probe[..., 2]
+    height, width = depth.shape
+    resolution = np.array([width, height])
+    points = unproject_pixels(scene, camera, depth)
+    center = np.stack(np.meshgrid(np.arange(width) + 0.5, np.arange(height)[::-1] + 0.5), axis=-1).reshape(-1, 2)
+
+    # the pixels of each object in its local space
+    pixels = []
+    for obj in objects:
+        index = np.flatnonzero(ids == np.float32(cryptomatte_hash(obj.name)))
+        if index.size == 0:
+            continue
+        matrix = np.array(obj.matrix_world.inverted())
+        pixels.append((obj, index, points[index] @ matrix[:3, :3].T + matrix[:3, 3]))
+
+    flow = np.zeros((height * width, 4), dtype=np.float32)
+    for offset, channels in ((-1, slice(0, 2)), (1, slice(2, 4))):
+        set_state(offset)
+        bpy.context.view_layer.update()
+        for obj, index, co in pixels:
+            matrix = np.array(obj.matrix_world)
+            position = project_vertices(scene, camera, co @ matrix[:3, :3].T + matrix[:3, 3])[:, :2] * resolution
+            if offset < 0:
+                flow[index, channels] = position - center[index]
+            else:
+                flow[index, channels] = center[index] - position
+    set_state(0)
+    bpy.context.view_layer.update()
+    return flow.reshape(height, width, 4)
+
+
+def view_state(rig, rotations, frame):
+    # set the rig to the neighbouring views, the first and last views only have one neighbour
+    def set_state(offset):
+        rig.rotation_euler = rotations[min(max(frame + offset, 0), len(rotations) - 1)]
+    return set_state
+
+
+def frame_state(frame):
+    def set_state(offset):
+        bpy.context.scene.frame_set(frame + offset)
+    return set_state
+
+
+def get_consistency(left, right, threshold=1.0):
+    """Left-right consistency masks of a pair of disparity maps
+
+    A pixel at column x of the left view is at x - disparity in the right view. It is kept
+    when the disparity found there agrees with its own, occluded and out of view pixels don't
+
+    Args:
+        left (ndarray): (height, width) disparity of the left view in pixels
+        right (ndarray): (height, width) disparity of the right view in pixels
+        threshold (float): largest difference in pixels between the two disparities
+
+    Returns:
+        tuple: boolean (height, width) masks of the left and right views
+    """
+    height, width = left.shape
+    rows = np.arange(height)[:, None]
+    columns = np.arange(width)
+    masks = []
+    for disparity, other, direction in ((left, right, -1), (right, left, 1)):
+        match = np.rint(columns + direction * disparity).astype(np.int64)
+        inside = (match >= 0) & (match < width)
+        found = other[rows, match.clip(0, width - 1)]
+        masks.append(inside & (np.abs(disparity - found) <= threshold))
+    return tuple(masks)
+
+
+def read_disparity(path, prefix, view):
+    # the disparity of a view, from its own file or from the multilayer file
+    layers = os.path.join(path, f"{prefix}layers_{view}.exr")
+    if os.path.exists(layers):
+        return exr.read_layer(layers, 'disparity')[..., 0]
+    channels = exr.read_exr(os.path.join(path, f"{prefix}disparity_{view}.exr"))
+    return channels.get('V', channels.get('R', next(iter(channels.values()))))
+
+
 def labels2txt(path, labels):
     with open(path + '.txt', 'w') as f:
         for item in [" ".join([str(a) for a in label]) for label in labels]:
@@ -1965,21 +2573,115 @@ def meshes2pkl(path, meshes):
         pickle.dump(meshes, f)
 
 
-def progress2tmp(batch_index, frame):
-    with open(".tmp", "w") as f:
-        f.write("%d\n" % batch_index)
-        f.write("%d\n" % frame)
+def instances2json(path, instances):
+    with open(path + '.json', 'w') as f:
+        json.dump(instances, f)
+
+
+def flow2exr(path, flow, settings):
+    # written like the cycles flow pass, the lossy codecs are not available in exr.py
+    codec = settings.get("codec", "ZIP").upper()
+    exr.write_exr(path + '.exr', {c: flow[..., i] for i, c in enumerate("RGBA")},
+                  compression=codec if codec in exr.WRITE_COMPRESSIONS else "ZIP",
+                  precision=settings.get("precision", "float"))
+
 
+def mask2png(path, mask):
+    # save a boolean mask as a black and white png through a reused blender image
+    height, width = mask.shape
+    image = bpy.data.images.get("mask")
+    if image is None:
+        image = bpy.data.images.new("mask", width, height, alpha=False)
+    elif tuple(image.size) != (width, height):
+        image.scale(width, height)
+    pixels = np.ones((height, width, 4), dtype=np.float32)
+    pixels[..., :3] = mask[::-1, :, None]
+    image.pixels.foreach_set(pixels.ravel())
+    image.filepath_raw = path + '.png'
+    image.file_format = 'PNG'
+    image.save()
 
-def tmp2progress():
-    progress = [0, 0]
+
+def get_staging_path(output_path):
+    # outputs are written here first and moved to the output once the frame is complete
+    return os.path.join(output_path, STAGING)
+
+
+def file_checksum(path):
+    crc = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def commit_frame(staging_path, output_path, batch_index, frame):
+    # move the staged files of a frame to the output and record them in the manifest
+    prefix = f'%0{FNAME_FORMAT}d_%0{FRAME_FORMAT}d' % (batch_index, frame)
+    files = {}
+    for name in sorted(os.listdir(staging_path)):
+        if not name.startswith(prefix):
+            continue
+        path = os.path.join(staging_path, name)
+        files[name] = {"size": os.path.getsize(path), "crc32": file_checksum(path)}
+        os.replace(path, os.path.join(output_path, name))
+
+    with open(os.path.join(output_path, MANIFEST), 'a') as f:
+        f.write(json.dumps({"batch": batch_index, "frame": frame, "files": files}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def finish_frame(staging_path, output_path, batch_index, frame, capture=None):
+    # commit the frame, or hand its capture to the encoders and commit the frames they finished
+    if capture is None:
+        commit_frame(staging_path, output_path, batch_index, frame)
+        return
+    capture.submit(frame, output_path=staging_path,
+                   prefix=f'%0{FNAME_FORMAT}d_%0{FRAME_FORMAT}d' % (batch_index, frame))
+    for done in capture.collect():
+        commit_frame(staging_path, output_path, batch_index, done)
+
+
+def verify_file(path, info, checksum=False):
     try:
-        with open(".tmp", "r") as f:
-            progress = [int(x) for x in f.read().splitlines()]
-    except:
-        return 0, 0
+        size = os.path.getsize(path)
+    except OSError:
+        return False
+    return size == info["size"] and (not checksum or file_checksum(path) == info["crc32"])
+
+
+def manifest2progress(output_path, checksum=False):
+    # the frames of each batch recorded in the manifest whose files are all present and intact
+    records = {}
+    try:
+        with open(os.path.join(output_path, MANIFEST), 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # interrupted while writing the last line
+                    continue
+                # a re-render of some passes only records the files it replaced
+                records.setdefault((record["batch"], record["frame"]), {}).update(record["files"])
+    except OSError:
+        return {}
+
+    progress = {}
+    for (batch_index, frame), files in records.items():
+        if all(verify_file(os.path.join(output_path, name), info, checksum) for name, info in files.items()):
+            progress.setdefault(batch_index, set()).add(frame)
+    return progress
+
 
-    return progress[0], progress[1]
+def scan_frames(output_path):
+    # the frames of each batch with files in an output directory, for outputs without a manifest
+    frames = {}
+    for name in os.listdir(output_path):
+        match = re.match(SEARCH_FRAME, name)
+        if match:
+            frames.setdefault(int(match.group(1)), set()).add(int(match.group(2)))
+    return frames
 
 
 def get_classes():
@@ -1987,7 +2689,27 @@ def get_classes():
     return CLASSES
 
 
-def create_annotations(objects, output_path, batch_index, frame):
+def create_flow(objects, output_path, batch_index, frame, set_state, settings, capture=None):
+    # write the analytic flow of a frame, as an array when the frame is captured to numpy
+    flow = get_flow(objects, set_state)
+    flow_path = os.path.join(
+        output_path, f'%0{FNAME_FORMAT}d_%0{FRAME_FORMAT}dflow' % (batch_index, frame))
+    if capture is not None:
+        np.save(flow_path + '.npy', flow.astype(capture.dtype))
+    else:
+        flow2exr(flow_path, flow, settings)
+
+
+def create_consistency(output_path, batch_index, frame, threshold, capture=None):
+    # write the left-right consistency masks of a frame from its disparity outputs
+    prefix = f'%0{FNAME_FORMAT}d_%0{FRAME_FORMAT}d' % (batch_index, frame)
+    source = output_path if capture is None else capture.scratch_path
+    masks = get_consistency(read_disparity(source, prefix, "L"), read_disparity(source, prefix, "R"), threshold)
+    for view, mask in zip("LR", masks):
+        mask2png(os.path.join(output_path, f"{prefix}consistency_{view}"), mask)
+
+
+def create_annotations(objects, output_path, batch_index, frame, instances=False):
     forward = mathutils.Vector((1, 0, 0))
     camera = bpy.context.scene.camera
     classes = get_classes()
@@ -1997,8 +2719,12 @@ def create_annotations(objects, output_path, batch_index, frame):
     for obj in objects:
         if obj.class_name not in classes:
             continue
-        camera_vertices = np.array([list(bpy_extras.object_utils.world_to_camera_view(bpy.context.scene, camera, mathutils.Vector(vertex.v))) for vertex in obj.world_vertices])
-        edges = np.array([list(i.vertices) for i in obj.data.edges])
+        camera_vertices = project_vertices(bpy.context.scene, camera, get_world_vertices(obj))
+        # decimated objects keep the edges of the full mesh their world vertices come from
+        mesh = obj.full_mesh or obj.data
+        edges = np.empty(len(mesh.edges) * 2, dtype=np.int32)
+        mesh.edges.foreach_get("vertices", edges)
+        edges = edges.reshape(-1, 2).astype(np.int64)
         labels.append((classes.index(obj.class_name),
                        *get_bbox(camera_vertices)))
         meshes.append((classes.index(obj.class_name),camera_vertices, edges))
@@ -2020,50 +2746,250 @@ def create_annotations(objects, output_path, batch_index, frame):
         output_path, f'%0{FNAME_FORMAT}d_%0{FRAME_FORMAT}dmesh' % (batch_index, frame))
     meshes2pkl(mesh_path, meshes)
 
+    # save the visible box and mask of each object taken from the cryptomatte pass
+    if instances:
+        instances_path = os.path.join(
+            output_path, f'%0{FNAME_FORMAT}d_%0{FRAME_FORMAT}dinstances' % (batch_index, frame))
+        instances2json(instances_path, get_instances(objects, classes))
 
-def render_views(objects, views, output_path, batch_index):
+
+def render_views(objects, views, output_path, batch_index, instances=False, border=None, capture=None, flow=None,
+                 consistency=None):
     frame = 0
     views_x, views_y, views_z = views
     total_views = len(views_x) * len(views_y) * len(views_z)
-    start_frame = 0 if batch_index > START_INDEX else START_FRAME
+    rotations = [(x, y, z) for x in views_x for y in views_y for z in views_z]
+    staging_path = get_staging_path(output_path)
+    done = RESUME.get(batch_index, set())
+    times = []
 
     for x in views_x:
         for y in views_y:
             for z in views_z:
 
-                if frame < start_frame:
+                if frame in done:
                     frame = frame + 1
                     continue
 
                 bpy.context.scene.frame_set(frame)
                 bpy.context.scene.camera.parent.rotation_euler = (x, y, z)
+                if border is not None:
+                    bpy.context.view_layer.update()
+                    set_render_border(objects, border)
 
+                ti = time.time()
                 old = blockPrint()
-                bpy.ops.render.render()
-                enablePrint(old)
-
-                create_annotations(objects, output_path, batch_index, frame)
+                try:
+                    bpy.ops.render.render()
+                finally:
+                    enablePrint(old)
+                times.append(time.time() - ti)
+
+                if flow is not None:
+                    create_flow(objects, staging_path, batch_index, frame,
+                                view_state(bpy.context.scene.camera.parent, rotations, frame), flow, capture)
+                if consistency is not None:
+                    create_consistency(staging_path, batch_index, frame, consistency, capture)
+                if not RERENDER:
+                    create_annotations(objects, staging_path, batch_index, frame, instances)
+                finish_frame(staging_path, output_path, batch_index, frame, capture)
                 update_progress(
                     f"Batch {batch_index}/{NUM_BATCHES-1} (step 4/4 rendering)", (frame + 1) / total_views)
-                progress2tmp(batch_index, frame)
                 frame = frame + 1
 
+    return times
 
-def render_animation(objects, frames, output_path, batch_index):
+
+def setup_animation_output(output_path, batch_index):
+    # an animation render always saves the render result, let it write the rgb pass instead
+    # of the compositor node. without a standalone rgb output it goes to a scratch directory
+    scene = bpy.context.scene
+    for node in scene.node_tree.nodes:
+        if node.bl_idname == "CompositorNodeOutputFile" and node.label in ("rgb", "stereo"):
+            node.mute = True
+            # the render result is what the composite node receives, the same image as the node
+            composite = scene.node_tree.nodes.new(type="CompositorNodeComposite")
+            scene.node_tree.links.new(node.inputs[0].links[0].from_socket, composite.inputs['Image'])
+            scene.render.image_settings.file_format = node.format.file_format
+            scene.render.image_settings.color_depth = node.format.color_depth
+            scene.render.image_settings.compression = node.format.compression
+            scene.render.image_settings.views_format = node.format.views_format
+            scene.render.filepath = os.path.join(
+                output_path, (f"%0{FNAME_FORMAT}d_" % batch_index) + "#" * FRAME_FORMAT + node.label)
+            return None
+    # multilayer outputs have none, the result is still written once per frame. make that
+    # write as cheap as possible, uncompressed and in memory when available
+    scratch = get_scratch_path()
+    scene.render.image_settings.file_format = 'BMP'
+    scene.render.filepath = os.path.join(scratch, "#" * FRAME_FORMAT)
+    return scratch
+
+
+def render_views_animation(objects, views, output_path, batch_index, instances=False, border=None, capture=None,
+                           consistency=None):
+    # keyframe the rig rotation of every view and render them all with one animation job
+    scene = bpy.context.scene
+    rig = scene.camera.parent
+    views_x, views_y, views_z = views
+    rotations = [(x, y, z) for x in views_x for y in views_y for z in views_z]
+    total_views = len(rotations)
+    staging_path = get_staging_path(output_path)
+    done = RESUME.get(batch_index, set())
+    missing = [frame for frame in range(total_views) if frame not in done]
+    if not missing:
+        return []
+
+    # the render border of each view is found before anything is keyframed
+    borders = []
+    if border is not None:
+        for rotation in rotations:
+            rig.rotation_euler = rotation
+            bpy.context.view_layer.update()
+            borders.append(get_render_border(objects, border))
+
+    rig.animation_data_clear()
+    for frame, rotation in enumerate(rotations):
+        rig.rotation_euler = rotation
+        rig.keyframe_insert(data_path="rotation_euler", frame=frame)
+    # hold each view for its frame, as when the views are rendered one by one
+    for fcurve in rig.animation_data.action.fcurves:
+        for keyframe in fcurve.keyframe_points:
+            keyframe.interpolation = 'CONSTANT'
+
+    # the border properties can't be keyframed, they are set when each frame starts. the
+    # border the job starts with covers every view, in case it is kept for the whole job
+    def set_border(scene, *args):
+        if 0 <= scene.frame_current < len(borders):
+            (scene.render.border_min_x, scene.render.border_min_y,
+             scene.render.border_max_x, scene.render.border_max_y) = borders[scene.frame_current]
+    if borders:
+        scene.render.use_border = True
+        scene.render.use_crop_to_border = False
+        (scene.render.border_min_x, scene.render.border_min_y) = np.min([b[:2] for b in borders], axis=0).tolist()
+        (scene.render.border_max_x, scene.render.border_max_y) = np.max([b[2:] for b in borders], axis=0).tolist()
+        bpy.app.handlers.frame_change_pre.append(set_border)
+
+    scene.frame_start = missing[0]
+    scene.frame_end = missing[-1]
+    scene.frame_step = 1
+    scratch = setup_animation_output(staging_path, batch_index)
+
+    stamps = [time.time()]
+    def stamp(*args):
+        stamps.append(time.time())
+    bpy.app.handlers.render_post.append(stamp)
+    old = blockPrint()
+    try:
+        bpy.ops.render.render(animation=True)
+    finally:
+        enablePrint(old)
+        bpy.app.handlers.render_post.remove(stamp)
+        if set_border in bpy.app.handlers.frame_change_pre:
+            bpy.app.handlers.frame_change_pre.remove(set_border)
+        if scratch is not None:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    # the annotations only need the keyframed camera, not a render
+    for frame in missing:
+        scene.frame_set(frame)
+        if consistency is not None:
+            create_consistency(staging_path, batch_index, frame, consistency, capture)
+        if not RERENDER:
+            create_annotations(objects, staging_path, batch_index, frame, instances)
+        finish_frame(staging_path, output_path, batch_index, frame, capture)
+        update_progress(
+            f"Batch {batch_index}/{NUM_BATCHES-1} (step 4/4 rendering)", (frame + 1) / total_views)
+
+    rig.animation_data_clear()
+    rig.rotation_euler = rotations[-1]
+    return list(np.diff(stamps))
+
+
+def render_animation(objects, frames, output_path, batch_index, instances=False, border=None, capture=None,
+                     flow=None, consistency=None):
     total_frames = len(frames)
-    start_frame = 0 if batch_index > START_INDEX else START_FRAME
+    staging_path = get_staging_path(output_path)
+    done = RESUME.get(batch_index, set())
+    times = []
+
+    for i, frame in enumerate(frames, 1):
+        if frame in done:
+            continue
 
-    for frame in frames[start_frame:]:
         bpy.context.scene.frame_set(frame)
+        if border is not None:
+            set_render_border(objects, border)
 
+        ti = time.time()
         old = blockPrint()
-        bpy.ops.render.render()
-        enablePrint(old)
-
-        create_annotations(objects, output_path, batch_index, frame)
+        try:
+            bpy.ops.render.render()
+        finally:
+            enablePrint(old)
+        times.append(time.time() - ti)
+
+        if flow is not None:
+            create_flow(objects, staging_path, batch_index, frame, frame_state(frame), flow, capture)
+        if consistency is not None:
+            create_consistency(staging_path, batch_index, frame, consistency, capture)
+        if not RERENDER:
+            create_annotations(objects, staging_path, batch_index, frame, instances)
+        finish_frame(staging_path, output_path, batch_index, frame, capture)
         update_progress(
-            f"Batch {batch_index}/{NUM_BATCHES-1} (step 4/4 rendering)", (frame + 1) / total_frames)
-        progress2tmp(batch_index, frame)
+            f"Batch {batch_index}/{NUM_BATCHES-1} (step 4/4 rendering)", i / total_frames)
+
+    return times
+
+
+def get_lod_ratio(size, tiers):
+    for pixels, ratio in sorted(tiers):
+        if size < pixels:
+            return ratio
+    return 1
+
+
+def decimate_object(obj, ratio):
+    # replace the mesh of the object by a decimated copy. the copies are cached per source
+    # mesh and ratio, and kept for the next batches
+    name = "lod_%08x" % zlib.crc32(f"{obj.source_key}:{ratio}".encode('utf-8'))
+    mesh = bpy.data.meshes.get(name)
+    if mesh is None:
+        modifier = obj.modifiers.new("lod", type='DECIMATE')
+        modifier.ratio = ratio
+        mesh = bpy.data.meshes.new_from_object(obj.evaluated_get(bpy.context.evaluated_depsgraph_get()))
+        obj.modifiers.remove(modifier)
+        mesh.name = name
+        mesh.use_fake_user = True
+    materials = list(obj.data.materials)
+    obj.full_mesh = obj.data
+    obj.data = mesh
+    # the copy is shared by the objects of its source mesh, their materials are linked to
+    # the object slots and the copy keeps the ones it was created with
+    for slot, material in zip(obj.material_slots, materials):
+        slot.link = 'OBJECT'
+        slot.material = material
+
+
+def setup_lod(objects, data):
+    # decimate the meshes that stay small on screen over the views of a render config,
+    # returns the ratio of each object
+    lod = data.get("lod", False)
+    if not lod:
+        return {}
+    settings = lod if isinstance(lod, dict) else {}
+    meshes = [obj for obj in objects if isinstance(obj.data, bpy.types.Mesh)]
+    sizes = get_projected_sizes(meshes, data)
+    ratios = {}
+    for obj in meshes:
+        ratios[obj.name] = get_lod_ratio(sizes[obj.name], settings.get("tiers", LOD_TIERS))
+        if ratios[obj.name] >= 1:
+            continue
+        decimate_object(obj, ratios[obj.name])
+        if not settings.get("full_annotations", True):
+            # annotate the decimated mesh, its vertices and edges
+            set_world_vertices(obj)
+            obj.full_mesh = None
+    return ratios
 
 
 def setup_imports(imports: List, batch_index):
@@ -2089,6 +3015,12 @@ def setup_imports(imports: List, batch_index):
         if isinstance(obj.data, bpy.types.Mesh):
             setup_object_data(obj, mats)
 
+        # variants only change the object properties read by the shared materials
+        set_variant(obj, asset.get("variant", {}))
+        if "variant" in asset:
+            for mat in mats:
+                setup_material_variants(mat)
+
         objects.append(obj)
         update_progress(
             f"Batch {batch_index}/{NUM_BATCHES-1} (step 1/4 import)", i/len(imports))
@@ -2111,38 +3043,143 @@ def setup_scene(data: Dict, batch_index):
     return rig, camera, lights
 
 
+def get_passes(data):
+    # the passes to write for a render config, all the passes of its type by default
+    render_type = data.get("type", "basic")
+    passes = data.get("passes", PASSES.get(render_type, []))
+    for name in passes:
+        if name not in PASSES.get(render_type, []) + DERIVED_PASSES.get(render_type, []):
+            raise ValueError(f"pass {name} is not available for {render_type} renders")
+    if "consistency" in passes and "disparity" not in passes:
+        raise ValueError("the consistency pass is computed from the disparity pass, request both")
+    return passes
+
+
+def get_render_frames(data):
+    # the frame numbers a render config produces
+    if "views" in data:
+        views_x, views_y, views_z = load_render_views(data["views"])
+        return list(range(len(views_x) * len(views_y) * len(views_z)))
+    if "frames" in data:
+        return list(load_render_frames(data["frames"]))
+    return []
+
+
+def get_border_margin(data):
+    # the margin around the objects when rendering with an automatic border, None when disabled
+    if not data.get("auto_border", False) or data.get("type", "basic") == "stereo":
+        return None
+    return data.get("border_margin", 0.05)
+
+
+def get_analytic_flow(data):
+    # the output settings of the flow when it is computed instead of rendered, None otherwise
+    if "flow" not in get_passes(data) or "flow" in PASSES.get(data.get("type", "basic"), []):
+        return None
+    return data.get("formats", {}).get("flow", {})
+
+
+def get_consistency_threshold(data):
+    # the threshold in pixels of the left-right consistency masks, None when they are not written
+    if "consistency" not in get_passes(data):
+        return None
+    # the masks read the disparity back with exr.py, which only decodes the lossless codecs
+    # stored a scanline at a time. blender writes ZIP by default
+    source = "layers" if data.get("multilayer", False) else "disparity"
+    codec = data.get("formats", {}).get(source, {}).get("codec", "ZIP").upper()
+    if data.get("capture", "files") == "numpy":
+        # captured frames are an uncompressed multilayer file
+        source, codec = "layers", "NONE"
+    if codec not in exr.LINES_PER_CHUNK:
+        raise ValueError(f"the consistency pass can't read a {codec} {source} file, use one of "
+                         f"{', '.join(exr.LINES_PER_CHUNK)} for formats.{source}.codec")
+    return data.get("consistency_threshold", 1.0)
+
+
+def setup_render_tree(data, output_path, batch_index):
+    # setup the engine and compositor for the render type, returns if instances are written
+    # and a description of the render profile
+    resolution = data.get("resolution", 256)
+    # instance masks are read from a single viewer, not available for stereo renders
+    instances = data.get("instances", False) and data.get("type", "basic") != "stereo"
+    formats = data.get("formats", {})
+    multilayer = data.get("multilayer", False)
+    if data.get("capture", "files") == "numpy":
+        # captured frames are a single uncompressed EXR, decoded by mapping it in memory
+        multilayer = True
+        precision = "float" if data.get("capture_dtype", "float16") == "float32" else "half"
+        formats = dict(formats, layers={"codec": "NONE", "precision": precision})
+    passes = get_passes(data)
+    border = get_border_margin(data) is not None
+    bpy.context.scene.render.use_border = False
+    profile = ""
+    if data.get("type", "basic") == "basic":
+        profile = setup_eevee_basic(resolution=resolution, base_path=output_path, id=batch_index,
+                                    instances=instances, formats=formats, multilayer=multilayer, passes=passes,
+                                    border=border, preset=data.get("preset"))
+    elif data.get("type", "basic") == "flow":
+        profile = setup_cycles_flow(resolution=resolution, base_path=output_path, id=batch_index,
+                                    instances=instances, formats=formats, multilayer=multilayer, passes=passes,
+                                    cycles=data.get("cycles", {}), border=border)
+    elif data.get("type", "basic") == "stereo":
+        profile = setup_eevee_stereo(resolution=resolution, base_path=output_path, id=batch_index,
+                                     formats=formats, multilayer=multilayer, passes=passes,
+                                     preset=data.get("preset"))
+    return instances, profile
+
+
 def render(objects, data, batch_index):
     # create output directory
     update_progress(
         f"Batch {batch_index}/{NUM_BATCHES-1} (step 3/4 setup output)", 0)
     output_path = os.path.abspath(data.get("path", "out"))
     Path(output_path).mkdir(parents=True, exist_ok=True)
+    # files left in the staging directory belong to an interrupted frame
+    staging_path = get_staging_path(output_path)
+    shutil.rmtree(staging_path, ignore_errors=True)
+    Path(staging_path).mkdir(parents=True, exist_ok=True)
+
+    # frames captured to numpy are written to a scratch directory and encoded in the background
+    capture = None
+    tree_path = staging_path
+    if data.get("capture", "files") == "numpy":
+        capture = EncoderPool(data.get("capture_workers", 2), dtype=data.get("capture_dtype", "float16"))
+        tree_path = capture.scratch_path
 
     # create the render tree
-    resolution = data.get("resolution", 256)
-    if data.get("type", "basic") == "basic":
-        setup_eevee_basic(resolution=resolution,
-                    base_path=output_path, id=batch_index)
-    elif data.get("type", "basic") == "flow":
-        setup_cycles_flow(resolution=resolution,
-                     base_path=output_path, id=batch_index)
-    elif data.get("type", "basic") == "stereo":
-        setup_eevee_stereo(resolution=resolution,
-                           base_path=output_path, id=batch_index)
+    instances, profile = setup_render_tree(data, tree_path, batch_index)
     update_progress(
         f"Batch {batch_index}/{NUM_BATCHES-1} (step 3/4 setup output)", 1)
 
     # Rendering type
     update_progress(
         f"Batch {batch_index}/{NUM_BATCHES-1} (step 4/4 rendering)", 0)
-    if "views" in data:
-        views = load_render_views(data["views"])
-        render_views(objects, views, output_path, batch_index)
-    elif "frames" in data:
-        frames = load_render_frames(data["frames"])
-        render_animation(objects, frames, output_path, batch_index)
+    times = []
+    border = get_border_margin(data)
+    flow = get_analytic_flow(data)
+    consistency = get_consistency_threshold(data)
+    try:
+        # the instances and analytic flow are read from the viewer after each render call
+        if "views" in data and data.get("animation", False) and not instances and flow is None:
+            views = load_render_views(data["views"])
+            times = render_views_animation(objects, views, output_path, batch_index, border=border, capture=capture,
+                                           consistency=consistency)
+        elif "views" in data:
+            views = load_render_views(data["views"])
+            times = render_views(objects, views, output_path, batch_index, instances, border, capture, flow,
+                                 consistency)
+        elif "frames" in data:
+            frames = load_render_frames(data["frames"])
+            times = render_animation(objects, frames, output_path, batch_index, instances, border, capture, flow,
+                                     consistency)
+    finally:
+        if capture is not None:
+            for frame in capture.close():
+                commit_frame(staging_path, output_path, batch_index, frame)
+            shutil.rmtree(capture.scratch_path, ignore_errors=True)
     update_progress(
         f"Batch {batch_index}/{NUM_BATCHES-1} (step 4/4 rendering)", 1)
+    report_timing(f"Batch {batch_index}/{NUM_BATCHES-1} render time", times, profile)
 
 
 if __name__ == "__main__":
@@ -2153,23 +3190,61 @@ if __name__ == "__main__":
     parser.add_argument(
         'json', type=str, help='Path to the json file to be used for rendering.')
     parser.add_argument('--resume', action='store_true',
-                        help='resume most recent render')
+                        help='only render the frames missing from the output manifests')
+    parser.add_argument('--verify', action='store_true',
+                        help='with --resume, also verify the checksums of the rendered files')
+    parser.add_argument('--rerender', type=str, nargs='+', metavar='PASS',
+                        help='only render these passes for the frames already in the output')
+    parser.add_argument('--output', type=str,
+                        help='output directory of every batch, instead of their render path')
     opt = sys.argv[sys.argv.index("--") + 1:]
     opt = parser.parse_args(opt)
+    if opt.rerender and opt.resume:
+        # --resume would skip the frames in the manifest, which are the ones to render again
+        parser.error("--rerender renders the frames already in the output, it can't be used with --resume")
     print(opt)
 
     with open(opt.json, 'r') as json_file:
         data = json.load(json_file)
 
-    START_INDEX, START_FRAME = tmp2progress() if opt.resume else (0, 0)
-
     CLASSES = data.get("classes", [])
     batches = data.get("batches", [])
     NUM_BATCHES = len(batches)
+    for batch in batches:
+        if opt.output:
+            batch.setdefault("render", {})["path"] = opt.output
+        if opt.rerender:
+            # instance masks are annotations, they are not rendered again. the passes are written
+            # as a file per pass, a new multilayer file would replace the one holding the others
+            batch.setdefault("render", {}).update(passes=opt.rerender, instances=False, multilayer=False)
+            get_passes(batch["render"])
+        # reject the render configs the consistency masks can't be computed for before rendering
+        get_consistency_threshold(batch.get("render", {}))
+    RERENDER = bool(opt.rerender)
+
+    # frames already rendered, per batch
+    RESUME = {}
+    if opt.resume:
+        output_paths = {os.path.abspath(b.get("render", {}).get("path", "out")) for b in batches}
+        for output_path in output_paths:
+            for batch_index, frames in manifest2progress(output_path, opt.verify).items():
+                RESUME.setdefault(batch_index, set()).update(frames)
+    elif opt.rerender:
+        # skip every frame that is not in the output yet
+        existing = {}
+        output_paths = {os.path.abspath(b.get("render", {}).get("path", "out")) for b in batches}
+        for output_path in output_paths:
+            if not os.path.isdir(output_path):
+                continue
+            progress = manifest2progress(output_path, opt.verify)
+            for batch_index, frames in (progress or scan_frames(output_path)).items():
+                existing.setdefault(batch_index, set()).update(frames)
+        for i, batch in enumerate(batches):
+            RESUME[i] = set(get_render_frames(batch.get("render", {}))) - existing.get(i, set())
 
     # run the script for each batch batches
     for i in range(NUM_BATCHES):
-        if i < START_INDEX:
+        if set(get_render_frames(batches[i].get("render", {}))) <= RESUME.get(i, set()):
             finish_progress(f"Batch {i}/{NUM_BATCHES-1}", 0)
             continue
         ti = time.time()
@@ -2178,6 +3253,7 @@ if __name__ == "__main__":
         objects = setup_imports(batch.get("imports", []), batch_index=i)
         rig, camera, lights = setup_scene(
             batch.get("scene", {}), batch_index=i)
+        setup_lod(objects, batch.get("render", {}))
         bpy.ops.scene.light_cache_bake(delay=0, subset='ALL')
         render(objects, batch.get("render", {}), batch_index=i)
         bpy.context.scene.name = f"batch_%0{FNAME_FORMAT}d" % i
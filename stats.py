@@ -0,0 +1,164 @@
+# Dataset statistics for training: mean and std per channel of the images and normals, the
+# depth range and the class and box histograms. Each frame gives its own statistics, merged
+# with Chan's parallel update, so the dataset builder computes them on its workers in the same
+# pass as the files and keeps them in its manifest for the frames that didn't change.
+
+import numpy as np
+
+from reader import decode_field, read_label, read_pixels
+
+
+STATS = "stats.json"
+# depth render.py writes for the background, inf once stored as half floats
+BACKGROUND_DEPTH = 1e10
+HISTOGRAM_BINS = 32
+
+
+class Moments():
+    """Count, mean, sum of squared differences to the mean, min and max per channel"""
+
+    def __init__(self, count=0, mean=0, m2=0, minimum=np.inf, maximum=-np.inf):
+        self.count = count
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.m2 = np.asarray(m2, dtype=np.float64)
+        self.minimum = np.asarray(minimum, dtype=np.float64)
+        self.maximum = np.asarray(maximum, dtype=np.float64)
+
+    @classmethod
+    def from_values(cls, values):
+        # values (samples, channels)
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return cls()
+        mean = values.mean(axis=0)
+        return cls(len(values), mean, ((values - mean) ** 2).sum(axis=0), values.min(axis=0), values.max(axis=0))
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            return other
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        return Moments(count, self.mean + delta * other.count / count,
+                       self.m2 + other.m2 + delta ** 2 * self.count * other.count / count,
+                       np.minimum(self.minimum, other.minimum), np.maximum(self.maximum, other.maximum))
+
+    def to_dict(self):
+        return {"count": self.count, "mean": self.mean.tolist(), "m2": self.m2.tolist(),
+                "min": self.minimum.tolist(), "max": self.maximum.tolist()}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["count"], data["mean"], data["m2"], data["min"], data["max"])
+
+    def summary(self):
+        if self.count == 0:
+            return {"count": 0}
+        return {"count": self.count, "mean": self.mean.tolist(), "std": np.sqrt(self.m2 / self.count).tolist(),
+                "min": self.minimum.tolist(), "max": self.maximum.tolist()}
+
+
+class DatasetStats():
+    """Mergeable statistics of frames
+
+    moments and histograms are keyed by quantity, e.g. rgb or depth, histograms being
+    (low, high, counts) over HISTOGRAM_BINS bins, and classes counts the objects per class
+    """
+
+    def __init__(self):
+        self.moments = {}
+        self.histograms = {}
+        self.classes = {}
+
+    def add_moments(self, name, values):
+        self.moments[name] = self.moments.get(name, Moments()).merge(Moments.from_values(values))
+
+    def check_range(self, name, low, high):
+        # histograms only add up over the same bins
+        if name in self.histograms and tuple(self.histograms[name][:2]) != (low, high):
+            raise ValueError(f"the {name} histogram ranges differ, {tuple(self.histograms[name][:2])} "
+                             f"and {(low, high)}")
+
+    def add_histogram(self, name, values, low, high):
+        self.check_range(name, low, high)
+        counts, _ = np.histogram(np.clip(values, low, high), bins=HISTOGRAM_BINS, range=(low, high))
+        if name in self.histograms:
+            counts = counts + np.asarray(self.histograms[name][2])
+        self.histograms[name] = (low, high, counts.tolist())
+
+    def merge(self, other):
+        for name, (low, high, _) in other.histograms.items():
+            self.check_range(name, low, high)
+        for name, moments in other.moments.items():
+            self.moments[name] = self.moments.get(name, Moments()).merge(moments)
+        for name, (low, high, counts) in other.histograms.items():
+            if name in self.histograms:
+                counts = (np.asarray(self.histograms[name][2]) + counts).tolist()
+            self.histograms[name] = (low, high, counts)
+        for name, count in other.classes.items():
+            self.classes[name] = self.classes.get(name, 0) + count
+        return self
+
+    def to_dict(self):
+        return {"moments": {name: moments.to_dict() for name, moments in self.moments.items()},
+                "histograms": self.histograms, "classes": self.classes}
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        stats.moments = {name: Moments.from_dict(moments) for name, moments in data["moments"].items()}
+        stats.histograms = {name: tuple(histogram) for name, histogram in data["histograms"].items()}
+        stats.classes = dict(data["classes"])
+        return stats
+
+    def summary(self):
+        return {"moments": {name: moments.summary() for name, moments in sorted(self.moments.items())},
+                "histograms": {name: {"range": [low, high], "counts": counts}
+                               for name, (low, high, counts) in sorted(self.histograms.items())},
+                "classes": dict(sorted(self.classes.items(), key=lambda item: int(item[0])))}
+
+
+def frame_stats(files, maxvalue=80):
+    """Statistics of a frame, both views of stereo renders together
+
+    Args:
+        files (dict): record field to its file, as yielded by FrameIndex
+        maxvalue (float): upper bound of the depth histogram
+
+    Returns:
+        dict: the DatasetStats of the frame as a dict
+    """
+    stats = DatasetStats()
+    for field, path in files.items():
+        name = field.rstrip('LR')
+        if name == "image":
+            # decoded BGR, stored RGB in [0, 1], any other channel dropped
+            stats.add_moments("rgb", decode_field(field, path)[..., :3].reshape(-1, 3)[:, ::-1] / 255)
+        elif name == "depth":
+            depth = read_pixels(path, "depth")[..., 0].ravel()
+            depth = depth[depth < BACKGROUND_DEPTH]
+            stats.add_moments("depth", depth[:, None])
+            stats.add_histogram("depth", depth, 0, maxvalue)
+        elif name == "normal":
+            # decoded like exr2normal in z y x order, stored x y z
+            normal = decode_field(field, path)[..., :3].reshape(-1, 3)[:, ::-1]
+            stats.add_moments("normal", normal)
+            for axis, channel in enumerate("xyz"):
+                stats.add_histogram(f"normal_{channel}", normal[:, axis], -1, 1)
+        elif name == "label":
+            labels = read_label(path)
+            for label in labels[:, 0].astype(int):
+                stats.classes[str(label)] = stats.classes.get(str(label), 0) + 1
+            stats.add_histogram("box_width", labels[:, 3], 0, 1)
+            stats.add_histogram("box_height", labels[:, 4], 0, 1)
+            stats.add_moments("box_center", labels[:, 1:3])
+    return stats.to_dict()
+
+
+def reduce_stats(frames):
+    # merge the statistics of frames, dicts as returned by frame_stats
+    stats = DatasetStats()
+    for frame in frames:
+        stats.merge(DatasetStats.from_dict(frame))
+    return stats
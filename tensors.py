@@ -0,0 +1,139 @@
+# Decodes the depth, normal, albedo and flow EXRs of the render output once into float16
+# memory mapped arrays, one (frames, height, width, channels) .npy per pass (and view for
+# stereo renders) indexed by tensors.json, so training doesn't decode EXRs every epoch.
+# The values are normalized as the PreviewData.ipynb functions do and the channels are in
+# the order opencv decodes them (BGR, BGRA for flow).
+# python tensors.py bdataset [--source out] [--test-step 3] [--passes depth normal albedo flow] [--maxvalue 80]
+#   [--workers 8]
+
+import os
+import json
+import itertools
+import argparse
+import numpy as np
+from os import getcwd
+from os.path import join
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+
+import exr
+from dataset_utils import (FrameIndex, bounded_map, frame_key, is_test, parse_name, report_incomplete,
+                           scan_passes)
+
+
+PASS_NAMES = ["depth", "normal", "albedo", "flow"]
+TENSOR_INDEX = "tensors.json"
+
+
+def decode(path, name, layer=None, maxvalue=80):
+    """Decode a pass as PreviewData.ipynb does
+
+    Args:
+        path (str): The EXR file of the pass, the multilayer file holding it or the .npy array
+            of a numpy capture
+        name (str): The pass name
+        layer (str): The layer of a multilayer file
+        maxvalue (float): depth clipping distance
+
+    Returns:
+        ndarray: (height, width, channels), depth clipped and scaled to [-1, 1], normal * 2 - 1
+    """
+    if path.endswith(".npy"):
+        # captured layers, in the channel order of the EXR layers
+        pixels = np.load(path, mmap_mode='r')
+    elif layer:
+        pixels = exr.read_layer(path, layer)
+    else:
+        pixels = next(iter(exr.read_layers(path).values()))
+    if name == "depth":
+        return np.minimum(pixels[..., :1], maxvalue) / maxvalue * 2 - 1
+    pixels = pixels[..., [2, 1, 0, 3] if name == "flow" else [2, 1, 0]]
+    if name == "normal":
+        return pixels * 2 - 1
+    return pixels
+
+
+def decode_into(job):
+    # decode one file into its row of a tensor, each worker maps the tensor itself
+    tensor_path, row, path, name, layer, maxvalue = job
+    tensor = np.load(tensor_path, mmap_mode='r+')
+    tensor[row] = decode(path, name, layer, maxvalue)
+    tensor.flush()
+
+
+def get_fields(data_path, passes):
+    # the fields of each requested pass present in the output, depth or depth_L and depth_R
+    present = scan_passes(data_path)
+    fields = {}
+    for name in passes:
+        for view in (None, "L", "R"):
+            if (name, view) in present:
+                fields[name if view is None else f"{name}_{view}"] = present[(name, view)]
+    return fields
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="decodes the EXR passes into float16 memory mapped arrays")
+    parser.add_argument("dest", type=str, default="bdataset")
+    parser.add_argument("--source", type=str, default="out", help="render output directory, in the working directory")
+    parser.add_argument("--test-step", type=int, default=3,
+                        help="one frame in this many goes to the test split, as given to dataset.py")
+    parser.add_argument("--passes", type=str, nargs='+', default=PASS_NAMES, choices=PASS_NAMES)
+    parser.add_argument("--maxvalue", type=float, default=80, help="depth clipping distance")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="decoding processes")
+    opt = parser.parse_args()
+
+    DATASET = opt.dest
+    wd = Path(getcwd())
+    root = wd.parent
+    data_path = Path(join(wd, opt.source))
+    dest = join(root, DATASET)
+    Path(dest).mkdir(parents=True, exist_ok=True)
+
+    fields = get_fields(data_path, opt.passes)
+    if not fields:
+        raise SystemExit(f"no {', '.join(opt.passes)} passes in {data_path}")
+    # a first scan counts the complete frames and gives the shape of every tensor, the second
+    # streams them to the decoders, a row per frame in the order they are found
+    index = FrameIndex(data_path, fields)
+    count, first = 0, None
+    for record in index:
+        first = first or record
+        count += 1
+    report_incomplete(index.incomplete)
+    if not count:
+        raise SystemExit("no complete frames")
+
+    tensors = {}
+    for field in fields:
+        path = first[2][field]
+        name = field.split('_')[0]
+        layer = name if parse_name(os.path.basename(path))[2] == "layers" else None
+        shape = (count,) + decode(path, name, layer, opt.maxvalue).shape
+        np.lib.format.open_memmap(join(dest, f"{field}.npy"), mode='w+', dtype=np.float16, shape=shape).flush()
+        tensors[field] = {"file": f"{field}.npy", "shape": list(shape), "dtype": "float16"}
+        if name == "depth":
+            tensors[field]["maxvalue"] = opt.maxvalue
+
+    keys = []
+    splits = {"train": [], "test": []}
+
+    def jobs():
+        for row, (batch, frame, files) in enumerate(itertools.islice(FrameIndex(data_path, fields), count)):
+            keys.append(frame_key(batch, frame))
+            splits["test" if is_test(batch, frame, opt.test_step) else "train"].append(row)
+            for field in fields:
+                name = field.split('_')[0]
+                layer = name if parse_name(os.path.basename(files[field]))[2] == "layers" else None
+                yield join(dest, tensors[field]["file"]), row, files[field], name, layer, opt.maxvalue
+
+    workers = max(1, opt.workers)
+    with ProcessPoolExecutor(workers) as pool:
+        for _ in tqdm(bounded_map(pool, decode_into, jobs(), 4 * workers), total=count * len(fields)):
+            pass
+    if len(keys) < count:
+        raise SystemExit(f"{count - len(keys)} frames were removed from {data_path} while decoding")
+
+    with open(join(dest, TENSOR_INDEX), "w") as f:
+        json.dump({"keys": keys, "splits": splits, "tensors": tensors}, f)
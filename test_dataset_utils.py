@@ -0,0 +1,37 @@
+# Checks of the frame matching of dataset_utils, no render output needed
+# python -m pytest test_dataset_utils.py
+
+import os
+
+from dataset_utils import FrameIndex
+
+
+def touch(path):
+    open(path, 'w').close()
+
+
+def test_pass_file_before_multilayer(tmp_path):
+    # every frame has the multilayer file and a depth rendered again on its own, whatever the
+    # order the directory lists them in the depth comes from its own file
+    for frame in range(40):
+        touch(tmp_path / ("0000_%06dlayers.exr" % frame))
+        touch(tmp_path / ("0000_%06ddepth.exr" % frame))
+    touch(tmp_path / "0001_000000layers.exr")
+    index = FrameIndex(str(tmp_path), {"depth": [("depth", None), ("layers", None)],
+                                       "normal": [("layers", None)]})
+    records = {(batch, frame): files for batch, frame, files in index}
+    assert len(records) == 41
+    for (batch, frame), files in records.items():
+        name = "depth" if batch == 0 else "layers"
+        assert os.path.basename(files["depth"]) == "%04d_%06d%s.exr" % (batch, frame, name)
+        assert os.path.basename(files["normal"]) == "%04d_%06dlayers.exr" % (batch, frame)
+    assert index.incomplete == {}
+
+
+def test_incomplete_frames(tmp_path):
+    touch(tmp_path / "0000_000000rgb.png")
+    touch(tmp_path / "0000_000000depth.exr")
+    touch(tmp_path / "0000_000001rgb.png")
+    index = FrameIndex(str(tmp_path), {"image": ("rgb", None), "depth": [("depth", None), ("layers", None)]})
+    assert [(batch, frame) for batch, frame, _ in index] == [(0, 0)]
+    assert index.incomplete == {(0, 1): ["depth"]}